@@ -12,20 +12,65 @@ SHEET_NAME = 'Orders UK'
 SECRET_KEY = os.getenv('SECRET_KEY', 'abc123')
 GOOGLE_CREDENTIALS = os.getenv('GOOGLE_CREDENTIALS')
 IS_RENDER = os.getenv('RENDER') == 'true'
+# Shared budget for every Sheets and Gmail call made by this process
+GOOGLE_API_REQUESTS_PER_MINUTE = float(os.getenv('GOOGLE_API_REQUESTS_PER_MINUTE', '60'))
+GOOGLE_HTTP_TIMEOUT_SECONDS = float(os.getenv('GOOGLE_HTTP_TIMEOUT_SECONDS', '60'))
 
 QUEUE_FILE = '/tmp/order_queue.json' if IS_RENDER else 'order_queue.json'
 FULFILLED_QUEUE_FILE = '/tmp/fulfilled_order_queue.json' if IS_RENDER else 'fulfilled_order_queue.json'
 FAILED_ORDERS_FILE = '/tmp/failed_orders.json' if IS_RENDER else 'failed_orders.json'
+STATE_DB_FILE = '/tmp/order_state.db' if IS_RENDER else 'order_state.db'
+WORKER_LOCK_FILE = '/tmp/queue_worker.lock' if IS_RENDER else 'queue_worker.lock'
+QUEUE_POLL_SECONDS = float(os.getenv('QUEUE_POLL_SECONDS', '30'))
+# How long a lane lets a burst of new orders accumulate before writing them in one append
+QUEUE_BATCH_WINDOW_SECONDS = float(os.getenv('QUEUE_BATCH_WINDOW_SECONDS', '2'))
+QUEUE_BATCH_SIZE = int(os.getenv('QUEUE_BATCH_SIZE', '50'))
+MAX_RETRIES = int(os.getenv('MAX_RETRIES', '6'))
+RETRY_BASE_SECONDS = float(os.getenv('RETRY_BASE_SECONDS', '30'))
+RETRY_MAX_SECONDS = float(os.getenv('RETRY_MAX_SECONDS', '1800'))
+IDEMPOTENCY_RETENTION_HOURS = float(os.getenv('IDEMPOTENCY_RETENTION_HOURS', '72'))
+# ETA reference data (arrival + webstocks sheets) is re-read this often, and the
+# last good copy is kept on disk for restarts
+REFERENCE_REFRESH_SECONDS = float(os.getenv('REFERENCE_REFRESH_SECONDS', '900'))
+REFERENCE_SNAPSHOT_FILE = '/tmp/eta_reference.json' if IS_RENDER else 'eta_reference.json'
+# Line-item context kept for recomputing ETAs of open rows
+ORDER_CONTEXT_RETENTION_DAYS = float(os.getenv('ORDER_CONTEXT_RETENTION_DAYS', '180'))
+# How long the in-memory copy of an Orders tab is trusted before a full re-read
+REPLICA_MAX_AGE_SECONDS = float(os.getenv('REPLICA_MAX_AGE_SECONDS', '300'))
+# Calls in flight at once per stage of the ETA follow-up pipeline, sized to
+# each external API's budget (Shopify GraphQL, SendGrid)
+SHOPIFY_CONCURRENCY = int(os.getenv('SHOPIFY_CONCURRENCY', '4'))
+EMAIL_CONCURRENCY = int(os.getenv('EMAIL_CONCURRENCY', '8'))
+SHOPIFY_TIMEOUT_SECONDS = float(os.getenv('SHOPIFY_TIMEOUT_SECONDS', '30'))
+# Orders looked up per Shopify GraphQL request (one aliased search each)
+SHOPIFY_ORDERS_PER_QUERY = int(os.getenv('SHOPIFY_ORDERS_PER_QUERY', '25'))
+# Times a throttled Shopify request is retried after waiting for the bucket to refill
+SHOPIFY_THROTTLE_RETRIES = int(os.getenv('SHOPIFY_THROTTLE_RETRIES', '5'))
+# A background job that has not reported progress for this long is treated as dead
+JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', '600'))
+JOB_RETENTION_DAYS = float(os.getenv('JOB_RETENTION_DAYS', '7'))
+
+# Tombstone mode: fulfilled rows are marked in TOMBSTONE_COLUMN straight away and
+# physically deleted by a compaction job every COMPACTION_INTERVAL_SECONDS
+FULFILLED_TOMBSTONES = os.getenv('FULFILLED_TOMBSTONES', 'false').lower() == 'true'
+TOMBSTONE_COLUMN = os.getenv('TOMBSTONE_COLUMN', 'O').strip().upper()
+# Only cells starting with this count as tombstones, so stray data in the column is never deleted
+TOMBSTONE_MARKER = 'Fulfilled '
+if FULFILLED_TOMBSTONES and not (len(TOMBSTONE_COLUMN) == 1 and 'O' <= TOMBSTONE_COLUMN <= 'Z'):
+    raise ValueError(f"TOMBSTONE_COLUMN must be a single column letter after N (O-Z), got {TOMBSTONE_COLUMN!r}")
+COMPACTION_INTERVAL_SECONDS = float(os.getenv('COMPACTION_INTERVAL_SECONDS', '900'))
+
+# One queue worker lane is started per store
+STORES = [store.strip() for store in os.getenv('STORES', 'UK,US,EU').split(',') if store.strip()]
 
 def get_store_configs():
     """
     Loads environment-based configurations for different store regions.
     """
 
-    stores = ["UK", "US", "EU"]
     store_configs = {}
 
-    for store in stores:
+    for store in STORES:
         store_configs[store] = {
             "SHOP_NAME": os.getenv(f"{store}_SHOP_NAME", ""),
             "API_KEY": os.getenv(f"{store}_API_KEY", ""),
@@ -3,8 +3,13 @@ from flask import Blueprint, request, jsonify
 import os
 import json
 import logging
-from config import SECRET_KEY, FAILED_ORDERS_FILE, QUEUE_FILE, FULFILLED_QUEUE_FILE
-from services.queue_handler import load_queue
+from config import SECRET_KEY, FAILED_ORDERS_FILE, QUEUE_FILE, FULFILLED_QUEUE_FILE, STORES
+from services.queue_handler import load_queue, clear_queue
+from services.sheets_service import get_service
+from services.sheet_replica import get_replica
+from services.reference_data import refresh as refresh_reference_data
+from services.jobs import start_job, get_job
+from utils.formulas import delete_duplicate_rows
 
 view_bp = Blueprint('view_routes', __name__)
 logger = logging.getLogger(__name__)
@@ -66,8 +71,7 @@ def clear_queue_view():
         queue_file = QUEUE_FILE
 
     try:
-        with open(queue_file, 'w') as f:
-            json.dump([], f)  # Clear the queue
+        clear_queue(queue_file)
 
         logger.info(f"Cleared {queue_type} queue from view route.")
         return jsonify({"status": "success", "message": f"{queue_type.capitalize()} queue cleared."}), 200
@@ -77,6 +81,71 @@ def clear_queue_view():
         return jsonify({"error": f"Failed to clear {queue_type} queue: {str(e)}"}), 500
 
 
+@view_bp.route('/repair_duplicates', methods=['POST'])
+def repair_duplicates_view():
+    provided_key = request.args.get('key')
+    if provided_key != SECRET_KEY:
+        return jsonify({"error": "Access Denied"}), 403
+
+    store = request.args.get('store', 'UK')
+    if store not in STORES:
+        return jsonify({"error": f"Unknown store {store}"}), 400
+
+    try:
+        # Full scan of a freshly read tab, for duplicates the incremental check cannot see
+        replica = get_replica(f"Orders {store}")
+        with replica.lock:
+            replica.refresh(get_service())
+            before = len(replica.rows)
+            delete_duplicate_rows(replica)
+            removed = before - len(replica.rows)
+
+        logger.info(f"Duplicate repair removed {removed} rows from Orders {store}")
+        return jsonify({"status": "success", "removed": removed}), 200
+
+    except Exception as e:
+        logger.error(f"Error repairing duplicates: {str(e)}")
+        return jsonify({"error": f"Failed to repair duplicates for {store}: {str(e)}"}), 500
+
+
+@view_bp.route('/refresh_reference_data', methods=['POST'])
+def refresh_reference_data_view():
+    provided_key = request.args.get('key')
+    if provided_key != SECRET_KEY:
+        return jsonify({"error": "Access Denied"}), 403
+
+    try:
+        # Reading the sheets and recomputing affected rows can outlast the HTTP timeout, so it runs
+        # in the background. The queue worker picks the new version up from the snapshot file if
+        # it runs in another process.
+        job_id, created = start_job("reference_refresh", _refresh_reference_data_job)
+        message = "ETA reference data refresh started." if created else "ETA reference data refresh already running."
+        return jsonify({"status": "accepted", "message": message, "job_id": job_id,
+                        "status_url": f"/refresh_reference_data/{job_id}"}), 202
+
+    except Exception as e:
+        logger.error(f"Error refreshing ETA reference data: {str(e)}")
+        return jsonify({"error": f"Failed to refresh ETA reference data: {str(e)}"}), 500
+
+
+def _refresh_reference_data_job(report):
+    data = refresh_reference_data()
+    logger.info(f"ETA reference data refreshed from view route, version {data.version}")
+    report({"version": data.version, "eta_keys": len(data.eta_index), "stock_entries": len(data.stock_data)})
+
+
+@view_bp.route('/refresh_reference_data/<job_id>', methods=['GET'])
+def refresh_reference_data_status(job_id):
+    provided_key = request.args.get('key')
+    if provided_key != SECRET_KEY:
+        return jsonify({"error": "Access Denied"}), 403
+
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": f"No job {job_id}"}), 404
+    return jsonify(job), 200
+
+
 @view_bp.route('/', methods=['GET'])
 def health_check():
     return jsonify({"status": "healthy"}), 200
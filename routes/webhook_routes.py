@@ -3,9 +3,10 @@ import logging
 import json
 from config import SECRET_KEY
 from config import QUEUE_FILE, FULFILLED_QUEUE_FILE
-from services.queue_handler import load_queue, save_queue, process_queue
-from services.order_processor import process_order, remove_fulfilled_sku
+from services.queue_handler import enqueue, idempotency_key
+from services.queue_worker import notify_worker
 from services.order_processor import check_and_notify_eta_updates
+from services.jobs import start_job, get_job
 from utils.helpers import clean_json
 
 webhook_bp = Blueprint('webhook_routes', __name__)
@@ -20,8 +21,6 @@ def handle_webhook():
     logger.info(f"Raw request data: {request.data.decode('utf-8')}")
     logger.info(f"Request headers: {request.headers}")
 
-    queue = load_queue(QUEUE_FILE)
-    fulfilled_queue = load_queue(FULFILLED_QUEUE_FILE)
     order_number = "Unknown"
     raw_data = request.data
     cleaned_data = clean_json(raw_data)
@@ -29,36 +28,33 @@ def handle_webhook():
     try:
         data = json.loads(cleaned_data)
         if not data:
-            queue.append({
+            enqueue({
                 "error": "No valid JSON data after cleaning",
                 "order_number": order_number,
                 "raw_data": raw_data.decode('utf-8')
-            })
-            save_queue(queue, QUEUE_FILE)
-            return jsonify({"status": "queued", "message": "Order queued with error: No valid JSON data"}), 200
+            }, QUEUE_FILE)
+            return jsonify({"status": "queued", "message": "Order queued with error: No valid JSON data"}), 202
 
         order_number = data.get("order_number", "Unknown")
         action = request.args.get('action', '')
 
-        if action == 'addNewOrders':
-            queue.append(data)
-            save_queue(queue, QUEUE_FILE)
-            process_queue(QUEUE_FILE, process_order)
-            return jsonify({"status": "queued", "message": f"Order {order_number} added to queue"}), 200
-        elif action == 'removeFulfilledSKU':
-            fulfilled_queue.append(data)
-            save_queue(fulfilled_queue, FULFILLED_QUEUE_FILE)
-            process_queue(FULFILLED_QUEUE_FILE, remove_fulfilled_sku)
-            return jsonify({"status": "queued", "message": f"Order {order_number} added to queue"}), 200
+        if action in ('addNewOrders', 'removeFulfilledSKU'):
+            queue_file = QUEUE_FILE if action == 'addNewOrders' else FULFILLED_QUEUE_FILE
+            # force=1 skips the duplicate check, e.g. when re-running a Flow by hand
+            key = None if request.args.get('force') == '1' else idempotency_key(data.get("store"), order_number, action, data)
+            if enqueue(data, queue_file, key) is None:
+                logger.info(f"Duplicate {action} webhook for order {order_number}, dropping")
+                return jsonify({"status": "duplicate", "message": f"Order {order_number} already received"}), 200
+            notify_worker(data.get("store"))
+            return jsonify({"status": "queued", "message": f"Order {order_number} added to queue"}), 202
         else:
             error_data = {
                 "error": f"Invalid action: {action}",
                 "order_number": order_number,
                 "raw_data": raw_data.decode('utf-8')
             }
-            queue.append(error_data)
-            save_queue(queue, QUEUE_FILE)
-            return jsonify({"status": "queued", "message": f"Order {order_number} queued with error: Invalid action"}), 200
+            enqueue(error_data, QUEUE_FILE)
+            return jsonify({"status": "queued", "message": f"Order {order_number} queued with error: Invalid action"}), 202
 
     except ValueError as e:
         logger.error(f"Failed to parse JSON: {str(e)}")
@@ -69,12 +65,10 @@ def handle_webhook():
         }
         # Decide queue based on action
         if request.args.get('action', '') == 'removeFulfilledSKU':
-            fulfilled_queue.append(error_data)
-            save_queue(fulfilled_queue, FULFILLED_QUEUE_FILE)
+            enqueue(error_data, FULFILLED_QUEUE_FILE)
         else:
-            queue.append(error_data)
-            save_queue(queue, QUEUE_FILE)
-        return jsonify({"status": "queued", "message": f"Order {order_number} queued with error: Invalid JSON"}), 200
+            enqueue(error_data, QUEUE_FILE)
+        return jsonify({"status": "queued", "message": f"Order {order_number} queued with error: Invalid JSON"}), 202
 
     except Exception as e:
         logger.error(f"Error processing webhook: {str(e)}")
@@ -85,12 +79,10 @@ def handle_webhook():
         }
         # Decide queue based on action
         if request.args.get('action', '') == 'removeFulfilledSKU':
-            fulfilled_queue.append(error_data)
-            save_queue(fulfilled_queue, FULFILLED_QUEUE_FILE)
+            enqueue(error_data, FULFILLED_QUEUE_FILE)
         else:
-            queue.append(error_data)
-            save_queue(queue, QUEUE_FILE)
-        return jsonify({"status": "queued", "message": f"Order {order_number} queued with error: {str(e)}"}), 200
+            enqueue(error_data, QUEUE_FILE)
+        return jsonify({"status": "queued", "message": f"Order {order_number} queued with error: {str(e)}"}), 202
 
 
 @webhook_bp.route('/check_eta_updates', methods=['GET'])
@@ -99,5 +91,20 @@ def check_all_eta_updates():
     if provided_key != SECRET_KEY:
         return jsonify({"error": "Access Denied"}), 403
 
-    check_and_notify_eta_updates()
-    return jsonify({"status": "success", "message": "ETA updates check complete!"}), 200
+    # The run can outlast the HTTP timeout, so it goes on in the background
+    job_id, created = start_job("eta_updates", check_and_notify_eta_updates)
+    message = "ETA updates check started." if created else "ETA updates check already running."
+    return jsonify({"status": "accepted", "message": message, "job_id": job_id,
+                    "status_url": f"/check_eta_updates/{job_id}"}), 202
+
+
+@webhook_bp.route('/check_eta_updates/<job_id>', methods=['GET'])
+def check_eta_updates_status(job_id):
+    provided_key = request.args.get('key')
+    if provided_key != SECRET_KEY:
+        return jsonify({"error": "Access Denied"}), 403
+
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": f"No job {job_id}"}), 404
+    return jsonify(job), 200
@@ -0,0 +1,120 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from config import JOB_STALE_SECONDS, JOB_RETENTION_DAYS
+from services.local_db import transaction, query
+
+logger = logging.getLogger(__name__)
+
+_schema_ready = False
+PROGRESS_WRITE_SECONDS = 1
+
+
+def _ensure_schema():
+    global _schema_ready
+    if _schema_ready:
+        return
+    with transaction() as conn:
+        # Kept in the state database so any worker process can answer a status request
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_kind ON jobs (kind, status)")
+    _schema_ready = True
+
+
+def _row_to_job(row):
+    return {
+        "job_id": row["job_id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "progress": json.loads(row["progress"]) if row["progress"] else {},
+        "error": row["error"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+def get_job(job_id):
+    _ensure_schema()
+    rows = query("SELECT * FROM jobs WHERE job_id = ?", (job_id,))
+    return _row_to_job(rows[0]) if rows else None
+
+
+def update_job(job_id, status=None, progress=None, error=None):
+    _ensure_schema()
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = COALESCE(?, status), progress = COALESCE(?, progress), "
+            "error = COALESCE(?, error), updated_at = ? WHERE job_id = ?",
+            (status, json.dumps(progress) if progress is not None else None, error, time.time(), job_id)
+        )
+
+
+def _claim(kind):
+    """Returns (job_id, created): the running job of this kind if there is one, else a new one."""
+    now = time.time()
+    with transaction() as conn:
+        # A job that stopped reporting progress belonged to a process that died
+        conn.execute("UPDATE jobs SET status = 'failed', error = 'abandoned' "
+                     "WHERE status = 'running' AND updated_at < ?", (now - JOB_STALE_SECONDS,))
+        conn.execute("DELETE FROM jobs WHERE created_at < ?", (now - JOB_RETENTION_DAYS * 86400,))
+        running = conn.execute("SELECT job_id FROM jobs WHERE kind = ? AND status = 'running'", (kind,)).fetchone()
+        if running:
+            return running["job_id"], False
+        job_id = uuid.uuid4().hex
+        conn.execute(
+            "INSERT INTO jobs (job_id, kind, status, progress, created_at, updated_at) VALUES (?, ?, 'running', '{}', ?, ?)",
+            (job_id, kind, now, now)
+        )
+        return job_id, True
+
+
+def start_job(kind, target):
+    """
+    Runs `target(report)` on a background thread and returns (job_id, created).
+    `report(progress)` stores a progress dict for the status endpoint. Only
+    one job of a kind runs at a time: while one is running its id is returned
+    instead of starting another.
+    """
+    _ensure_schema()
+    job_id, created = _claim(kind)
+    if not created:
+        logger.info(f"{kind} job {job_id} is already running")
+        return job_id, False
+
+    latest = {"progress": None, "written": 0}
+    report_lock = threading.Lock()
+
+    def report(progress):
+        # Stages report after every item; the database only needs a sample
+        with report_lock:
+            latest["progress"] = progress
+            now = time.monotonic()
+            if now - latest["written"] < PROGRESS_WRITE_SECONDS:
+                return
+            latest["written"] = now
+        update_job(job_id, progress=progress)
+
+    def run():
+        try:
+            target(report)
+            update_job(job_id, status="complete", progress=latest["progress"])
+            logger.info(f"{kind} job {job_id} complete")
+        except Exception as e:
+            logger.error(f"{kind} job {job_id} failed: {str(e)}")
+            update_job(job_id, status="failed", progress=latest["progress"], error=str(e))
+
+    threading.Thread(target=run, name=f"job-{kind}", daemon=True).start()
+    logger.info(f"Started {kind} job {job_id}")
+    return job_id, True
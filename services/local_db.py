@@ -0,0 +1,58 @@
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+from config import STATE_DB_FILE
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+_connection = None
+
+
+def get_connection():
+    """
+    Returns the process-wide SQLite connection used for local durable state.
+    WAL journaling keeps every commit atomic, so a crash mid-write never
+    leaves a truncated file behind.
+    """
+    global _connection
+    with _lock:
+        if _connection is None:
+            conn = sqlite3.connect(STATE_DB_FILE, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+            _connection = conn
+            logger.info(f"Opened local state database at {STATE_DB_FILE}")
+        return _connection
+
+
+@contextmanager
+def transaction():
+    """Runs the enclosed statements as one atomic write transaction."""
+    conn = get_connection()
+    with _lock:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+def query(sql, params=()):
+    conn = get_connection()
+    with _lock:
+        return conn.execute(sql, params).fetchall()
+
+
+def ensure_columns(table, columns):
+    """Adds any of `columns` ({name: declaration}) missing from an existing table."""
+    conn = get_connection()
+    with _lock:
+        existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, declaration in columns.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
@@ -0,0 +1,94 @@
+import logging
+import time
+from config import ORDER_CONTEXT_RETENTION_DAYS
+from services.local_db import transaction, query
+
+logger = logging.getLogger(__name__)
+
+_schema_ready = False
+_last_prune = 0
+PRUNE_INTERVAL_SECONDS = 86400
+
+
+def _ensure_schema():
+    global _schema_ready
+    if _schema_ready:
+        return
+    with transaction() as conn:
+        # What the sheet rows do not hold but an ETA recompute needs
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS order_items (
+                store TEXT NOT NULL,
+                order_number TEXT NOT NULL,
+                sku TEXT NOT NULL,
+                barcode TEXT,
+                inventory INTEGER,
+                order_created TEXT NOT NULL,
+                recorded_at REAL NOT NULL,
+                PRIMARY KEY (store, order_number, sku)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_recorded ON order_items (recorded_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_barcode ON order_items (store, barcode)")
+    _schema_ready = True
+
+
+def _prune(conn):
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < PRUNE_INTERVAL_SECONDS:
+        return
+    _last_prune = now
+    conn.execute("DELETE FROM order_items WHERE recorded_at < ?", (now - ORDER_CONTEXT_RETENTION_DAYS * 86400,))
+
+
+def record_order_items(store, order_number, order_created, line_items):
+    """Remembers the order date, barcode and inventory of each line item written to the sheet."""
+    _ensure_schema()
+    now = time.time()
+    with transaction() as conn:
+        for item in line_items:
+            conn.execute(
+                "INSERT OR REPLACE INTO order_items "
+                "(store, order_number, sku, barcode, inventory, order_created, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (store, str(order_number), str(item.get('sku')), item.get('barcode'),
+                 item.get('inventory', -1), order_created, now)
+            )
+        _prune(conn)
+
+
+def load_order_items(store, order_numbers):
+    """Returns {(order_number, sku): {"barcode", "inventory", "order_created"}} for the given orders of a store."""
+    _ensure_schema()
+    items = {}
+    order_numbers = list(order_numbers)
+    for start in range(0, len(order_numbers), 500):
+        chunk = order_numbers[start:start + 500]
+        rows = query(
+            f"SELECT order_number, sku, barcode, inventory, order_created FROM order_items "
+            f"WHERE store = ? AND order_number IN ({', '.join('?' * len(chunk))})",
+            (store, *chunk)
+        )
+        for row in rows:
+            items[(row["order_number"], row["sku"])] = {
+                "barcode": row["barcode"],
+                "inventory": row["inventory"] if row["inventory"] is not None else -1,
+                "order_created": row["order_created"],
+            }
+    return items
+
+
+def find_items_by_barcode(store, barcodes):
+    """(order_number, sku) of every recorded line item of a store whose barcode is one of `barcodes`."""
+    _ensure_schema()
+    items = set()
+    barcodes = [barcode for barcode in barcodes if barcode]
+    for start in range(0, len(barcodes), 500):
+        chunk = barcodes[start:start + 500]
+        rows = query(
+            f"SELECT order_number, sku FROM order_items "
+            f"WHERE store = ? AND barcode IN ({', '.join('?' * len(chunk))})",
+            (store, *chunk)
+        )
+        items.update((row["order_number"], row["sku"]) for row in rows)
+    return items
@@ -3,327 +3,618 @@ import logging
 import json
 from flask import jsonify
 from datetime import datetime
-from config import SPREADSHEET_ID, get_store_configs
+from config import SPREADSHEET_ID, STORES, FULFILLED_TOMBSTONES, TOMBSTONE_COLUMN, TOMBSTONE_MARKER, get_store_configs
+from config import SHOPIFY_CONCURRENCY, EMAIL_CONCURRENCY, SHOPIFY_ORDERS_PER_QUERY
 from utils.helpers import format_date
-from services.sheets_service import get_service, update_sheet_with_retry
-from utils.formulas import delete_rows, delete_duplicate_rows
-from utils.eta import get_eta, build_eta_lookup, load_sheet_data
+from services.sheets_service import get_service, append_rows, delete_sheet_rows
+from services.sheet_replica import get_replica, ReplicaWriter
+from utils.formulas import delete_rows, delete_duplicate_rows, delete_tombstoned_rows
+from utils.eta import get_eta_batch, get_eta_rows
+from services.reference_data import get_reference_data
+from services.order_context import record_order_items, load_order_items, find_items_by_barcode
+from services.pipeline import Pipeline, Stage
 from utils.email_utils import first_draft, send_email, follow_up_draft, error_draft
-from utils.shopify_graphql import update_note, get_order_data
+from utils.shopify_graphql import update_note, get_orders_data
 
 logger = logging.getLogger(__name__)
-service = get_service()
 
-stores = ['UK', 'US', 'EU']
+def process_order(data):
+    return process_orders([data])[0]
+
+
+def _build_order_rows(data, store):
+    """Resolves ETAs for every line item and returns the sheet rows plus the order country."""
+    order_number = data.get("order_number", "Unknown")
+    order_country = data.get("order_country", "Unknown")
+    customer_lang = data.get("customer_lang", "en-GB")
+    customer_email = data.get("customer_email", "Unknown")
+    order_created = format_date(data.get("order_created", ""))
+    line_items = data.get("line_items", [])
+    reference = get_reference_data()
+    etas = get_eta_batch(line_items, store, order_created, reference.eta_index, reference.stock_data)
+
+    rows_data = []
+    for idx, (item, eta) in enumerate(zip(line_items, etas)):
+        title, quantity, sku, vendor = item['title'], item['quantity'], item['sku'], item['vendor']
+        url = item['url']
+
+        item["Latest ETA On Hand"] = eta
+        item["Index"] = idx  # Store index for later updates
+
+        if "mlperformance.co.uk" in url:
+            order_country = "GB"
+        elif "mlpautoteile.de" in url and customer_lang == "en-DE":
+            order_country = "DE"
+        elif store == "US":
+            order_country = "GB"
+        elif "mlpautoteile.de" in url and customer_lang != "en-DE":
+            order_country = "GB"
+
+        rows_data.append([order_number, title, quantity, sku, vendor, eta, customer_email])
+    return rows_data, order_country
+
+
+def _notify_new_order(writer, data, store, SHEET_NAME, replica, order_country):
+    order_number = data.get("order_number", "Unknown")
+    order_id = data.get("order_id", "")
+    customer_email = data.get("customer_email", "Unknown")
+    customer_name = data.get("customer_name", "Unknown")
+    is_dealer = data.get("is_dealer", False)
+    line_items = data.get("line_items", [])
+
+    # Send email
+    if not is_dealer and customer_email and customer_email not in ['sales@mlperformanceusa.com', 'hello@masata.co.uk']:
+        store_configs, _ = get_store_configs()
+        store_db = store_configs.get(store, store_configs["UK"])  # fallback to UK
+
+        order_info = {
+            "Order Number": order_number,
+            "Order ID": order_id,
+            "Line Items": line_items
+        }
+
+        draft = first_draft(order_info, customer_name, store_db, store, order_country)
+        send_email(customer_email, draft, store_db)
+
+        # Update columns H and J, written with the rest of the batch.
+        # Rows are matched by SKU so the cleanup removing some of them cannot shift the rest.
+        sku_rows = {}
+        for item in line_items:
+            rows = sku_rows.setdefault(str(item['sku']), replica.find_rows(order_number, str(item['sku'])))
+            if not rows:
+                continue  # row was removed by the cleanup
+            row_index = rows.pop(0) + 1
+            writer.set_cell(SHEET_NAME, 'H', row_index, str(item["Latest ETA On Hand"]))
+            writer.set_cell(SHEET_NAME, 'J', row_index, f"Sent On {datetime.today().strftime('%d-%m-%Y')}")
+
+        if store == "US":
+            update_note(order_info, store_configs["UK"])
+            order_info['Order ID'] = 'gid://shopify/Order/' + str(data.get("order_id_us", ""))
+        update_note(order_info, store_db)
+
+        logger.info(f"Email sent to {customer_email} and spreadsheet updated for {order_number}")
+    else:
+        logger.info(f"No email sent for dealer or skipped emails for {order_number}")
+
+
+def process_orders(batch):
+    """
+    Writes several queued orders for the same store with a single append call,
+    then sends each order's confirmation. Returns one success flag per order.
+    """
+    service = get_service()
+    if not service:
+        logger.error("Google Sheets service not initialized")
+        return [False] * len(batch)
 
-ARRIVAL_SHEET_ID = "1hElJ_sWXGy1-Psk9x2EPrXeZuFjKreR_B7cj3voxBIA"
-arrival_data = load_sheet_data(ARRIVAL_SHEET_ID, "General!A1:G")
-eta_map = build_eta_lookup(arrival_data)
+    store = batch[0].get("store")
+    SHEET_NAME = f"Orders {store}"
+    replica = get_replica(SHEET_NAME)
+    with replica.lock:
+        return _process_orders_locked(service, batch, store, SHEET_NAME, replica)
 
-WEBSTOCKS_SHEET_ID = "102UjR-rv6X5k3p22x0wE6r-5BWe7e4-FNjx3SbB05Gg"
-webstocks_data = load_sheet_data(WEBSTOCKS_SHEET_ID, "webstocks!A2:A")
-stock_data = set(row[0] for row in webstocks_data if row)  # Flatten to set of SKUs/barcodes
 
-def get_last_row(SPREADSHEET_ID, SHEET_NAME):
+def _process_orders_locked(service, batch, store, SHEET_NAME, replica):
+    # An order only counts as handled once it is written, or found not to need writing
+    results = [False] * len(batch)
+    pending = []
     try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID, range=f'{SHEET_NAME}!A:A'
-        ).execute()
-        values = result.get('values', [])
-        return len(values) + 1 if values else 2
+        # Appends and deletes are applied to the replica locally, so it is only re-read when stale
+        replica.sync(service)
+        order_numbers = set()
+
+        for position, data in enumerate(batch):
+            order_number = data.get("order_number", "Unknown")
+            logger.info(f"Processing order {order_number}")
+            # A duplicate is acked for good, so check the replica's rows against the sheet first
+            duplicate = replica.has_order(str(order_number))
+            if duplicate and not replica.confirm_rows(service, replica.find_rows(str(order_number))):
+                duplicate = replica.has_order(str(order_number))  # the replica has been refreshed
+            if duplicate or str(order_number) in order_numbers:
+                logger.warning(f"Duplicate order {order_number}")
+                results[position] = True
+                continue
+            if not data.get("line_items", []):
+                logger.warning(f"Order {order_number} has no line items")
+                results[position] = True
+                continue
+            try:
+                rows_data, order_country = _build_order_rows(data, store)
+            except Exception as e:
+                # A malformed payload fails on its own; the rest of the batch is still written
+                logger.error(f"Error building rows for order {order_number}: {str(e)}")
+                continue
+            order_numbers.add(str(order_number))
+            pending.append((position, data, rows_data, order_country))
+
+        if not pending:
+            return results
+
+        all_rows = [row for _, _, rows_data, _ in pending for row in rows_data]
+        first_row = append_rows(service, SPREADSHEET_ID, SHEET_NAME, all_rows)
+        appended = replica.record_append(first_row, all_rows)
+        logger.info(f"Appended {len(all_rows)} rows for {len(pending)} orders to {SHEET_NAME} at row {first_row}")
+        _record_order_context(store, pending)
+
+        delete_rows(replica)
+        delete_duplicate_rows(replica, appended)
     except Exception as e:
-        logger.error(f"Error getting last row: {str(e)}")
-        return 2
+        logger.error(f"Error processing orders for {SHEET_NAME}: {str(e)}")
+        replica.invalidate()  # the append may have landed even if we did not see the response
+        _report_sheet_error(e)
+        return results
 
-def get_sheet_id(SPREADSHEET_ID, SHEET_NAME):
-    spreadsheet = service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
-    for sheet in spreadsheet['sheets']:
-        if sheet['properties']['title'] == SHEET_NAME:
-            return sheet['properties']['sheetId']
-    raise Exception(f"Sheet ID not found for {SHEET_NAME}")
+    for position, _, _, _ in pending:
+        results[position] = True
 
-def process_order(data):
-    if not service:
-        logger.error("Google Sheets service not initialized")
-        return False
     try:
-        store = data.get("store")
-        SHEET_NAME = f"Orders {store}"
+        # Rows below our own were placed from a replica that may be minutes old
+        replica.confirm_rows(service, [i for _, data, _, _ in pending
+                                       for i in replica.find_rows(str(data.get("order_number", "Unknown")))])
+    except Exception as e:
+        logger.error(f"Error confirming rows of {SHEET_NAME}: {str(e)}")
+        _report_sheet_error(e)
+        for position, _, _, _ in pending:
+            results[position] = False
+        return results
+
+    writer = ReplicaWriter(service, SPREADSHEET_ID)
+    notified = []
+    for position, data, rows_data, order_country in pending:
         order_number = data.get("order_number", "Unknown")
-        logger.info(f"Processing order {order_number}")
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID, range=f'{SHEET_NAME}!A:A'
-        ).execute()
-        order_numbers = [row[0] for row in result.get('values', []) if row]
-        if str(order_number) in order_numbers:
-            logger.warning(f"Duplicate order {order_number}")
-            return True
-
-        order_id = data.get("order_id", "")
-        order_country = data.get("order_country", "Unknown")
-        customer_lang = data.get("customer_lang", "en-GB")
-        customer_email = data.get("customer_email", "Unknown")
-        customer_name = data.get("customer_name", "Unknown")
-        is_dealer = data.get("is_dealer", False)
-        order_created = format_date(data.get("order_created", ""))
-        line_items = data.get("line_items", [])
-        
-        if not line_items:
-            logger.warning(f"Order {order_number} has no line items")
-            return True
-
-        rows_data = []
-        for idx, item in enumerate(line_items):
-            title, quantity, sku, vendor, barcode = item['title'], item['quantity'], item['sku'], item['vendor'], item['barcode']
-            inventory, url = item['inventory'], item['url']
-            eta = get_eta(sku, vendor, store, barcode, inventory, order_created, eta_map, stock_data)
-            
-            item["Latest ETA On Hand"] = eta
-            item["Index"] = idx  # Store index for later updates
-
-            if "mlperformance.co.uk" in url:
-                order_country = "GB"
-            elif "mlpautoteile.de" in url and customer_lang == "en-DE":
-                order_country = "DE"
-            elif store == "US":
-                order_country = "GB"
-            elif "mlpautoteile.de" in url and customer_lang != "en-DE":
-                order_country = "GB"
-
-            rows_data.append([order_number, title, quantity, sku, vendor, eta, customer_email])
-
-        start_row = max(2, get_last_row(SPREADSHEET_ID, SHEET_NAME))
-        
-        range_to_write = f'{SHEET_NAME}!A{start_row}'
-        body = {'values': rows_data}
-        update_sheet_with_retry(service, SPREADSHEET_ID, range_to_write, body)
-
-        delete_rows()
-        delete_duplicate_rows()
-
-        # Check if rows still exist after deletion
-        result_check = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f'{SHEET_NAME}!A:A'
-        ).execute()
-        current_order_numbers = [row[0] for row in result_check.get('values', []) if row]
-
-        if order_number and order_number in current_order_numbers:
-        # if order_number == '#MLP152009' and order_number in current_order_numbers:
-        
-            # Send email
-            if not is_dealer and customer_email and customer_email not in ['sales@mlperformanceusa.com', 'hello@masata.co.uk']:
-                store_configs, _ = get_store_configs()
-                store_db = store_configs.get(store, store_configs["UK"])  # fallback to UK
-
-                order_info = {
-                    "Order Number": order_number,
-                    "Order ID": order_id,
-                    "Line Items": line_items
-                }
-
-                draft = first_draft(order_info, customer_name, store_db, store, order_country)
-                send_email(customer_email, draft, store_db)
-
-                # Update columns I and K
-                for item in line_items:
-                    row_index = start_row + item["Index"]
-                    service.spreadsheets().values().update(
-                        spreadsheetId=SPREADSHEET_ID,
-                        range=f'{SHEET_NAME}!H{row_index}',
-                        valueInputOption='RAW',
-                        body={'values': [[str(item["Latest ETA On Hand"])]]}
-                    ).execute()
-                    service.spreadsheets().values().update(
-                        spreadsheetId=SPREADSHEET_ID,
-                        range=f'{SHEET_NAME}!J{row_index}',
-                        valueInputOption='RAW',
-                        body={'values': [[f"Sent On {datetime.today().strftime('%d-%m-%Y')}"]]}
-                    ).execute()
-
-                if store == "US":
-                    update_note(order_info, store_configs["UK"])
-                    order_info['Order ID'] = 'gid://shopify/Order/' + str(data.get("order_id_us", ""))
-                update_note(order_info, store_db)
-
-                logger.info(f"Email sent to {customer_email} and spreadsheet updated for {order_number}")
+        try:
+            # Check if rows still exist after deletion
+            if order_number and replica.has_order(order_number):
+                _notify_new_order(writer, data, store, SHEET_NAME, replica, order_country)
+                notified.append(position)
             else:
-                logger.info(f"No email sent for dealer or skipped emails for {order_number}")
-        else:
-            logger.info(f"Order {order_number} was removed as duplicate or invalid. Skipping email.")
+                logger.info(f"Order {order_number} was removed as duplicate or invalid. Skipping email.")
+        except Exception as e:
+            logger.error(f"Error processing order {order_number}: {str(e)}")
+            _report_sheet_error(e)
+            results[position] = False
 
-        return True
+    try:
+        writer.flush()
     except Exception as e:
-        logger.error(f"Error processing order {order_number}: {str(e)}")
-        if "exceeds grid limits" in str(e) or "Invalid range" in str(e):
-            try:
-                draft = error_draft(str(e))
-                error_email = 'iffah@mlperformance.co.uk'
-                store_configs, _ = get_store_configs()
-                store_db = store_configs.get("UK")
-                send_email(error_email, draft, store_db)
-                logger.info(f"Error email sent for order {order_number}")
-            except Exception as email_error:
-                logger.error(f"Failed to send error notification email: {str(email_error)}")
+        logger.error(f"Error writing email status to {SHEET_NAME}: {str(e)}")
+        _report_sheet_error(e)
+        for position in notified:
+            results[position] = False
+
+    return results
+
+
+def _scan_eta_updates(store):
+    """Pipeline stage: the orders of a store tab whose Latest ETA On Hand differs from the ETA last quoted."""
+    SHEET_NAME = f"Orders {store}"
+    logger.info(f"Checking ETA updates for {store} store")
+    service = get_service()
+    # Work from a copy of the replica so the lock is not held while emails go out
+    replica = get_replica(SHEET_NAME)
+    with replica.lock:
+        replica.sync(service)
+        rows = [list(row) for row in replica.rows]
+
+    if not rows:
+        logger.info("No data found.")
+        return []
+
+    # Identify indices
+    header = rows[0]
+    latest_eta_on_hand_idx = header.index('Latest ETA On Hand')
+    email_idx = header.index('Email')
+    latest_eta_quoted_idx = header.index('Latest ETA Quoted')
+    order_number_idx = header.index('Order Number')
+    sku_idx = header.index('SKU')
+    title_idx = header.index('Product')
+    quantity_idx = header.index('Quantity')
+
+    # Group mismatching rows by order so each order gets one lookup, one email and one note
+    mismatches = {}
+    for i, row in enumerate(rows[1:], start=2):  # Skip header, 1-based index
+        if replica.is_tombstoned(row):
+            continue  # fulfilled, waiting for compaction
+        latest_eta_on_hand = row[latest_eta_on_hand_idx] if len(row) > latest_eta_on_hand_idx else ""
+        latest_eta_quoted = row[latest_eta_quoted_idx] if len(row) > latest_eta_quoted_idx else ""
+        email = row[email_idx] if len(row) > email_idx else ""
+        order_number = row[order_number_idx] if len(row) > order_number_idx else ""
+
+        # Check for mismatch
+        if latest_eta_quoted and latest_eta_on_hand and latest_eta_on_hand != latest_eta_quoted:
+            logger.info(f"ETA update found for row {i}: {email}")
+            mismatches.setdefault((order_number, email), []).append((i, {
+                "title": row[title_idx] if len(row) > title_idx else "",
+                "quantity": row[quantity_idx] if len(row) > quantity_idx else "",
+                "sku": row[sku_idx] if len(row) > sku_idx else "",
+                "Latest ETA On Hand": latest_eta_on_hand
+            }))
+
+    store_configs, _ = get_store_configs()
+    orders = [{
+        "store": store,
+        "sheet_name": SHEET_NAME,
+        "store_configs": store_configs,
+        "store_db": store_configs.get(store, store_configs["UK"]),  # fallback to UK
+        "order_number": order_number,
+        "email": email,
+        "rows": items,
+    } for (order_number, email), items in mismatches.items()]
+    # Handed on in chunks so the lookup stage can fetch each chunk with one request
+    return [orders[start:start + SHOPIFY_ORDERS_PER_QUERY] for start in range(0, len(orders), SHOPIFY_ORDERS_PER_QUERY)]
+
+
+def _lookup_eta_orders(orders):
+    """
+    Pipeline stage: fetches the customer details for a chunk of orders of
+    one store with a single Shopify request (plus one on the UK store for
+    US orders, whose note is copied there). Orders tagged Skip Email stop here.
+    """
+    store, store_configs = orders[0]["store"], orders[0]["store_configs"]
+    order_numbers = [order["order_number"] for order in orders]
+    found = get_orders_data(order_numbers, orders[0]["store_db"])
+    found_uk = get_orders_data(order_numbers, store_configs["UK"]) if store == "US" else {}
+
+    looked_up = []
+    for order in orders:
+        graphql_order_data = found.get(order["order_number"])
+        if graphql_order_data is None:
+            logger.error(f"Error sending ETA update for order {order['order_number']}: order not found in Shopify")
+            continue
+        order["uk_order_id"] = (found_uk.get(order["order_number"]) or {}).get('Order ID', '')
+        if _prepare_eta_order(order, graphql_order_data):
+            looked_up.append(order)
+    return looked_up
+
+
+def _prepare_eta_order(order, graphql_order_data):
+    store = order["store"]
+    order_info = {
+        "Order Number": order["order_number"],
+        "Order ID": '',
+        "Line Items": [item for _, item in order["rows"]]
+    }
+
+    order_info['Order ID'] = graphql_order_data.get('Order ID', '')
+    domain = graphql_order_data.get('Domain', '')
+    customer_lang = graphql_order_data.get('Locale', 'en-GB')
+    skip_email = graphql_order_data.get('Skip Email', False)
+
+    order_country = "Unknown"
+    if "mlperformance.co.uk" in domain:
+        order_country = "GB"
+    elif "mlpautoteile.de" in domain and customer_lang == "en-DE":
+        order_country = "DE"
+    elif store == "US":
+        order_country = "GB"
+    elif "mlpautoteile.de" in domain and customer_lang != "en-DE":
+        order_country = "GB"
+
+    if skip_email:
         return False
 
+    order["order_info"] = order_info
+    order["customer_name"] = graphql_order_data.get('Customer First Name', 'Customer')
+    order["order_country"] = order_country
+    return True
 
-def remove_fulfilled_sku(data):
+
+def _render_eta_email(order):
+    """Pipeline stage: builds the follow-up email listing every changed item of the order."""
+    order["draft"] = follow_up_draft(order["order_info"], order["customer_name"], order["store_db"],
+                                     order["store"], order["order_country"])
+    return order
+
+
+def _send_eta_email(order):
+    """Pipeline stage: sends the follow-up email."""
+    send_email(order["email"], order["draft"], order["store_db"])  # your existing email sender!
+    return order
+
+
+def _update_eta_notes(order):
+    """
+    Pipeline stage: adds the new ETAs to the Shopify order note (and the UK
+    copy of a US order). The email has gone out by now, so a failed note is
+    logged and the order still counts as notified.
+    """
+    order_number, order_info = order["order_number"], order["order_info"]
     try:
-        store = data.get("store")
-        SHEET_NAME = f"Orders {store}"
-        order_number = data.get("order_number", "Unknown")
-        line_items = data.get("line_items", [])
-        logger.info(f"Processing remove_fulfilled_sku for order {order_number}, line_items: {line_items}")
-
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID, range=f'{SHEET_NAME}!A:N'
-        ).execute()
-        values = result.get('values', [])
-        logger.info(f"Retrieved {len(values)} rows from sheet")
-
-        rows_to_delete = []
-
-        for i, row in enumerate(values):
-            if len(row) > 1 and row[0] == order_number:
-                row_sku = str(row[3])
-                if not line_items:
-                    rows_to_delete.append(i)
+        update_note(order_info, order["store_db"])
+        if order["store"] == "US":
+            order_info['Order ID'] = order["uk_order_id"]
+            update_note(order_info, order["store_configs"]["UK"])
+    except Exception as e:
+        logger.error(f"Error updating note for order {order_number}: {str(e)}")
+    return order
+
+
+def _write_eta_updates(service, SHEET_NAME, orders):
+    """
+    Sets Latest ETA Quoted (column H) and Last Email Sent? (column K) of the
+    notified rows with one batch. Rows that moved since the scan (e.g. a
+    fulfilment removed rows above them) are looked up again, and the rows
+    are confirmed against the sheet before writing.
+    """
+    sent_on = f"Sent On {datetime.today().strftime('%d-%m-%Y')}"
+    replica = get_replica(SHEET_NAME)
+    writer = ReplicaWriter(service, SPREADSHEET_ID)
+    with replica.lock:
+        replica.sync(service)
+        for i, eta in replica.confirm_plan(service, lambda: _plan_eta_updates(replica, orders)):
+            writer.set_cell(SHEET_NAME, 'H', i + 1, eta)
+            writer.set_cell(SHEET_NAME, 'K', i + 1, sent_on)
+        return writer.flush()
+
+
+def _plan_eta_updates(replica, orders):
+    """The (row index, quoted ETA) of every notified row, where the replica has it now."""
+    cells = []
+    for order in orders:
+        for i, item in order["rows"]:
+            current = replica.find_rows(order["order_number"], item["sku"])
+            if i - 1 not in current:
+                if not current:
+                    logger.warning(f"Row for {order['order_number']} {item['sku']} is gone, ETA not recorded")
                     continue
-                for item in line_items:
-                    sku = str(item.get('sku'))
-                    if sku == row_sku:
-                        rows_to_delete.append(i)
-
-        if rows_to_delete:
-            rows_to_delete.sort(reverse=True)
-            sheet_id = get_sheet_id(SPREADSHEET_ID, SHEET_NAME)
-            requests = [{
-                "deleteDimension": {
-                    "range": {
-                        "sheetId": sheet_id,
-                        "dimension": "ROWS",
-                        "startIndex": i,
-                        "endIndex": i + 1
-                    }
-                }
-            } for i in rows_to_delete]
-            service.spreadsheets().batchUpdate(
-                spreadsheetId=SPREADSHEET_ID, body={"requests": requests}
-            ).execute()
-            logger.info(f"Deleted rows: {rows_to_delete}")
-            return True  # ✅ rows were found and deleted
-
-        logger.info(f"No matching rows for {order_number}, no deletion needed.")
-        return False  # ❌ no matching rows
+                i = current[0] + 1
+            cells.append((i - 1, item["Latest ETA On Hand"]))
+    return cells
 
+
+def _record_order_context(store, pending):
+    try:
+        for _, data, _, _ in pending:
+            order_number = data.get("order_number", "Unknown")
+            order_created = format_date(data.get("order_created", ""))
+            if order_created == "Invalid Date":
+                logger.warning(f"Order {order_number} has no valid order date, its ETAs will not be recomputed")
+                continue
+            record_order_items(store, order_number, order_created, data.get("line_items", []))
     except Exception as e:
-        logger.error(f"Error in remove_fulfilled_sku for order {order_number}: {str(e)}")
-        return False
+        # Only the re-ETA job needs this, so it must never fail the order
+        logger.error(f"Error recording order context for {store}: {str(e)}")
+
+
+def _plan_reeta(replica, store, names, current, stats):
+    """
+    The (row index, new ETA) of every open row of `names` whose ETA changed.
+    The sheet only holds SKU and vendor, so rows whose barcode is among
+    `names` (stock changes can be keyed by barcode) are found through the
+    recorded order context.
+    """
+    indexes = {i for i in replica.find_rows_by_item(names) if i > 0}  # skip header
+    for order_number, sku in find_items_by_barcode(store, names):
+        indexes.update(i for i in replica.find_rows(order_number, sku) if i > 0)
+    indexes = sorted(indexes)
+    context = load_order_items(store, {replica.rows[i][0] for i in indexes})
+
+    found = []
+    line_items = []
+    missing = 0
+    for i in indexes:
+        row = replica.rows[i]
+        item = context.get((row[0], row[3]))
+        if item is None:
+            missing += 1  # written before order context was recorded
+            continue
+        found.append(i)
+        line_items.append({'sku': row[3], 'vendor': row[4] if len(row) > 4 else '', 'barcode': item['barcode'],
+                           'inventory': item['inventory'], 'order_created': item['order_created']})
+
+    cells = []
+    for i, eta in zip(found, get_eta_rows(line_items, store, current.eta_index, current.stock_data)):
+        row = replica.rows[i]
+        if eta is None:
+            # An unparseable order date; skip the row rather than the whole tab
+            logger.warning(f"Cannot recompute ETA of {row[0]} {row[3]}: invalid order date")
+            missing += 1
+        elif eta != (row[5] if len(row) > 5 else ''):
+            cells.append((i, eta))
+    stats.update(affected=len(indexes), missing=missing)
+    return cells
+
+
+def reeta_changed_rows(previous, current):
+    """
+    Reference data listener: recomputes "Latest ETA On Hand" (column F) of
+    the open rows whose SKU or vendor has a new badge or stock status, and
+    writes the changed ones with one batch per store. check_and_notify_eta_updates
+    then tells the customers.
+    """
+    names = previous.eta_index.changed_names(current.eta_index) | (previous.stock_data ^ current.stock_data)
+    if not names:
+        return
+    logger.info(f"ETA reference data changed for {len(names)} SKUs/vendors, recomputing affected rows")
+
+    service = get_service()
+    for store in STORES:
+        SHEET_NAME = f"Orders {store}"
+        replica = get_replica(SHEET_NAME)
+        try:
+            with replica.lock:
+                replica.sync(service)
+                # The replica may be minutes old, so the rows are checked before their ETAs are written
+                stats = {}
+                cells = replica.confirm_plan(service, lambda: _plan_reeta(replica, store, names, current, stats))
+
+                writer = ReplicaWriter(service, SPREADSHEET_ID)
+                for i, eta in cells:
+                    writer.set_cell(SHEET_NAME, 'F', i + 1, eta)
+                updated = writer.flush()
+            logger.info(f"Re-ETA for {SHEET_NAME}: {stats['affected']} affected rows, {updated} updated, "
+                        f"{stats['missing']} without usable order context")
+        except Exception as e:
+            logger.error(f"Error recomputing ETAs for {SHEET_NAME}: {str(e)}")
+            replica.invalidate()
 
 
-def check_and_notify_eta_updates():
-    for store in stores:
-        logger.info(f"Checking ETA updates for {store} store")
+def _report_sheet_error(e):
+    if "exceeds grid limits" in str(e) or "Invalid range" in str(e):
         try:
-            SHEET_NAME = f"Orders {store}"
-            # Fetch the data
-            result = service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID, range=f'{SHEET_NAME}!A:N'
-            ).execute()
-            rows = result.get('values', [])
+            draft = error_draft(str(e))
+            error_email = 'iffah@mlperformance.co.uk'
+            store_configs, _ = get_store_configs()
+            store_db = store_configs.get("UK")
+            send_email(error_email, draft, store_db)
+            logger.info("Error email sent for sheet error")
+        except Exception as email_error:
+            logger.error(f"Failed to send error notification email: {str(email_error)}")
 
-            if not rows:
-                logger.info("No data found.")
-                return
-
-            # Identify indices
-            header = rows[0]
-            latest_eta_on_hand_idx = header.index('Latest ETA On Hand')
-            email_idx = header.index('Email')
-            latest_eta_quoted_idx = header.index('Latest ETA Quoted')
-            order_number_idx = header.index('Order Number')
-            sku_idx = header.index('SKU')
-            title_idx = header.index('Product')
-            quantity_idx = header.index('Quantity')
-
-            # Prepare updates
-            updates = []
-            for i, row in enumerate(rows[1:], start=2):  # Skip header, 1-based index
-                latest_eta_on_hand = row[latest_eta_on_hand_idx] if len(row) > latest_eta_on_hand_idx else ""
-                latest_eta_quoted = row[latest_eta_quoted_idx] if len(row) > latest_eta_quoted_idx else ""
-                email = row[email_idx] if len(row) > email_idx else ""
-                order_number = row[order_number_idx] if len(row) > order_number_idx else ""
-                sku = row[sku_idx] if len(row) > sku_idx else ""
-                title = row[title_idx] if len(row) > title_idx else ""
-                quantity = row[quantity_idx] if len(row) > quantity_idx else ""
-                
-
-                # Check for mismatch
-                if latest_eta_quoted and latest_eta_on_hand and latest_eta_on_hand != latest_eta_quoted:
-                    logger.info(f"ETA update found for row {i}: {email}")
-                    
-                    store_configs, _ = get_store_configs()
-                    store_db = store_configs.get(store, store_configs["UK"])  # fallback to UK
-
-                    order_info = {
-                        "Order Number": order_number,
-                        "Order ID": '',
-                        "Line Items": [{
-                            "title": title,  # Adjust based on your actual column index for title
-                            "quantity": quantity,
-                            "sku": sku,
-                            "Latest ETA On Hand": latest_eta_on_hand
-                        }]
-                    }
-
-                    graphql_order_data = get_order_data(order_number, store_db)
-                    order_info['Order ID'] = graphql_order_data.get('Order ID', '')
-                    domain = graphql_order_data.get('Domain', '')
-                    customer_lang = graphql_order_data.get('Locale', 'en-GB')
-                    customer_name = graphql_order_data.get('Customer First Name', 'Customer')
-                    skip_email = graphql_order_data.get('Skip Email', False)
-
-                    if "mlperformance.co.uk" in domain:
-                        order_country = "GB"
-                    elif "mlpautoteile.de" in domain and customer_lang == "en-DE":
-                        order_country = "DE"
-                    elif store == "US":
-                        order_country = "GB"
-                    elif "mlpautoteile.de" in domain and customer_lang != "en-DE":
-                        order_country = "GB"
-
-                    if not skip_email:
-                        draft = follow_up_draft(order_info, customer_name, store_db, store, order_country)
-                        send_email(email, draft, store_db)  # your existing email sender!
-
-                        # Update Latest ETA Quoted
-                        updates.append({
-                            'range': f'{SHEET_NAME}!H{i}',  # Column H for Latest ETA Quoted
-                            'values': [[latest_eta_on_hand]]
-                        })
-
-                        updates.append({
-                            'range': f'{SHEET_NAME}!K{i}',  # Column J: Last Email Sent?
-                            'values': [[f"Sent On {datetime.today().strftime('%d-%m-%Y')}"]]
-                        })
-
-                        update_note(order_info, store_db)
-                        if store == "US":
-                            store_db = store_configs["UK"]
-                            graphql_order_data = get_order_data(order_number, store_db)
-                            order_info['Order ID'] = graphql_order_data.get('Order ID', '')
-                            update_note(order_info, store_configs["UK"])
-                        
-            # Batch update to Google Sheets
-            if updates:
-                body = {'valueInputOption': 'RAW', 'data': updates}
-                service.spreadsheets().values().batchUpdate(
-                    spreadsheetId=SPREADSHEET_ID, body=body
-                ).execute()
-                logger.info("Updated Latest ETA Quoted for all notified rows.")
-            else:
-                logger.info("No ETA updates found.")
 
+def remove_fulfilled_sku(data):
+    return remove_fulfilled_skus([data])[0]
+
+
+def remove_fulfilled_skus(batch):
+    """
+    Removes the rows of many fulfilment events at once: every event of a
+    store is matched against the same copy of its tab and all matched rows go
+    out in one combined write. Returns one result per event: True when its
+    rows were removed, False when nothing matched, None when an error stopped
+    it (so the queue retries it instead of dropping it).
+    """
+    service = get_service()
+    results = [None] * len(batch)
+    by_store = {}
+    for position, data in enumerate(batch):
+        by_store.setdefault(data.get("store"), []).append(position)
+
+    for store, positions in by_store.items():
+        SHEET_NAME = f"Orders {store}"
+        events = [batch[position] for position in positions]
+        for data in events:
+            logger.info(f"Processing remove_fulfilled_sku for order {data.get('order_number', 'Unknown')}, "
+                        f"line_items: {data.get('line_items', [])}")
+        try:
+            replica = get_replica(SHEET_NAME)
+            with replica.lock:
+                found = _remove_fulfilled_rows(service, replica, SHEET_NAME, events)
+            for position, success in zip(positions, found):
+                results[position] = success
+        except Exception as e:
+            order_numbers = [data.get("order_number", "Unknown") for data in events]
+            logger.error(f"Error in remove_fulfilled_sku for orders {order_numbers}: {str(e)}")
+            get_replica(SHEET_NAME).invalidate()  # the delete may have landed even if we did not see the response
+    return results
+
+
+def _find_fulfilled_rows(replica, order_number, line_items):
+    if not line_items:
+        return [i for i in replica.find_rows(order_number) if len(replica.rows[i]) > 1]
+    rows_to_delete = []
+    for item in line_items:
+        rows_to_delete.extend(replica.find_rows(order_number, str(item.get('sku'))))
+    return rows_to_delete
+
+
+def _match_fulfilled_rows(replica, events):
+    return [_find_fulfilled_rows(replica, data.get("order_number", "Unknown"), data.get("line_items", []))
+            for data in events]
+
+
+def _remove_fulfilled_rows(service, replica, SHEET_NAME, events):
+    replica.sync(service)
+    matches = _match_fulfilled_rows(replica, events)
+    if not all(matches):
+        # A miss is rare, so make sure it is not just the replica lagging behind
+        replica.refresh(service)
+        matches = _match_fulfilled_rows(replica, events)
+    elif not replica.confirm_rows(service, [i for rows in matches for i in rows]):
+        matches = _match_fulfilled_rows(replica, events)
+
+    for data, rows in zip(events, matches):
+        if not rows:
+            logger.info(f"No matching rows for {data.get('order_number', 'Unknown')}, no deletion needed.")
+
+    rows_to_delete = sorted({i for rows in matches for i in rows}, reverse=True)
+    if rows_to_delete and FULFILLED_TOMBSTONES:
+        # Mark the rows now and leave the physical delete to compact_fulfilled_rows
+        writer = ReplicaWriter(service, SPREADSHEET_ID)
+        for i in rows_to_delete:
+            writer.set_cell(SHEET_NAME, TOMBSTONE_COLUMN, i + 1, f"{TOMBSTONE_MARKER}{datetime.today().strftime('%d-%m-%Y')}")
+        writer.flush()
+        logger.info(f"Tombstoned rows: {rows_to_delete}")
+    elif rows_to_delete:
+        delete_sheet_rows(service, SPREADSHEET_ID, SHEET_NAME, rows_to_delete)
+        replica.record_delete(rows_to_delete)
+        logger.info(f"Deleted rows: {rows_to_delete}")
+
+    return [bool(rows) for rows in matches]
+
+
+def compact_fulfilled_rows():
+    """Deletes the rows tombstoned by remove_fulfilled_sku, one merged batchUpdate per store tab."""
+    service = get_service()
+    for store in STORES:
+        replica = get_replica(f"Orders {store}")
+        try:
+            with replica.lock:
+                replica.sync(service)
+                delete_tombstoned_rows(replica)
         except Exception as e:
+            logger.error(f"Error compacting Orders {store}: {str(e)}")
+            replica.invalidate()
+
+
+def check_and_notify_eta_updates(report=None):
+    """
+    Emails customers whose items' ETA changed since it was last quoted.
+    Orders flow through scan, Shopify lookup, render, send and note stages,
+    each with its own bounded pool, so the run takes about as long as the
+    slowest API's share of the work rather than the sum of every call. The
+    sheet is written last, one batch per store. `report(progress)` receives
+    the per-stage counts as the run goes; the final counts are returned.
+    """
+    pipeline = Pipeline([
+        Stage("scan", _scan_eta_updates, len(STORES), fan_out=True),
+        Stage("lookup", _lookup_eta_orders, SHOPIFY_CONCURRENCY, fan_out=True),
+        Stage("render", _render_eta_email, 1),
+        Stage("send", _send_eta_email, EMAIL_CONCURRENCY),
+        Stage("note", _update_eta_notes, SHOPIFY_CONCURRENCY),
+    ], on_progress=report)
+    notified = pipeline.run(STORES)
+
+    service = get_service()
+    written = {"queued": 0, "done": 0, "failed": 0}
+    for store in STORES:
+        SHEET_NAME = f"Orders {store}"
+        orders = [order for order in notified if order["sheet_name"] == SHEET_NAME]
+        if not orders:
+            logger.info(f"No ETA updates found for {store}.")
+            continue
+        written["queued"] += 1
+        try:
+            _write_eta_updates(service, SHEET_NAME, orders)
+            written["done"] += 1
+            logger.info(f"Updated Latest ETA Quoted for {len(orders)} notified orders in {SHEET_NAME}.")
+        except Exception as e:
+            written["failed"] += 1
             logger.error(f"Error in check_and_notify_eta_updates: {str(e)}")
+            _report_sheet_error(e)
+
+    progress = pipeline.snapshot()
+    progress["write-back"] = written
+    if report:
+        report(progress)
+    return progress
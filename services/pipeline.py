@@ -0,0 +1,84 @@
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# `fn(item)` returns the item for the next stage, or None to stop there.
+# A fan_out stage returns an iterable and each element goes on separately.
+Stage = namedtuple("Stage", ["name", "fn", "workers", "fan_out"], defaults=[False])
+
+
+class Pipeline:
+    """
+    Runs items through a chain of stages, each on its own bounded thread pool,
+    so one stage's calls overlap with the others' instead of queueing behind
+    them. Each stage is limited to `workers` calls at a time. An item that
+    raises is logged, counted as failed and dropped; the rest carry on.
+    """
+
+    def __init__(self, stages, on_progress=None):
+        self.stages = stages
+        self.on_progress = on_progress
+        self.progress = {stage.name: {"queued": 0, "done": 0, "failed": 0} for stage in stages}
+        self.results = []
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self._executors = []
+
+    def _submit(self, position, item):
+        stage = self.stages[position]
+        with self._lock:
+            self._pending += 1
+            self.progress[stage.name]["queued"] += 1
+        self._executors[position].submit(self._run_stage, position, item)
+
+    def _run_stage(self, position, item):
+        stage = self.stages[position]
+        try:
+            output = stage.fn(item)
+            outputs = list(output or []) if stage.fan_out else ([] if output is None else [output])
+            status = "done"
+        except Exception as e:
+            logger.error(f"Pipeline stage {stage.name} failed: {str(e)}")
+            outputs = []
+            status = "failed"
+
+        for output in outputs:
+            if position + 1 < len(self.stages):
+                self._submit(position + 1, output)
+            else:
+                with self._lock:
+                    self.results.append(output)
+
+        with self._lock:
+            self.progress[stage.name][status] += 1
+            self._pending -= 1
+            if not self._pending:
+                self._idle.notify_all()
+        if self.on_progress:
+            try:
+                self.on_progress(self.snapshot())
+            except Exception as e:
+                logger.error(f"Pipeline progress callback failed: {str(e)}")
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(counts) for name, counts in self.progress.items()}
+
+    def run(self, items):
+        """Feeds `items` to the first stage and blocks until every item has left the pipeline."""
+        self._executors = [ThreadPoolExecutor(max_workers=max(1, stage.workers), thread_name_prefix=f"pipeline-{stage.name}")
+                           for stage in self.stages]
+        try:
+            for item in items:
+                self._submit(0, item)
+            with self._lock:
+                while self._pending:
+                    self._idle.wait()
+        finally:
+            for executor in self._executors:
+                executor.shutdown(wait=True)
+        return self.results
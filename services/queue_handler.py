@@ -1,75 +1,405 @@
-
 import json
 import os
 import logging
 import time
-from config import FAILED_ORDERS_FILE
+import hashlib
+import random
+from config import FAILED_ORDERS_FILE, IDEMPOTENCY_RETENTION_HOURS, MAX_RETRIES, RETRY_BASE_SECONDS, RETRY_MAX_SECONDS
+from services.local_db import transaction, query, ensure_columns
 from services.order_processor import process_order
 
 logger = logging.getLogger(__name__)
 
+_schema_ready = False
+_imported_files = set()
+_last_prune = 0
+PRUNE_INTERVAL_SECONDS = 600
+
+
+def _ensure_schema():
+    global _schema_ready
+    if _schema_ready:
+        return
+    # DDL goes through transaction() so it never lands inside another thread's open transaction
+    with transaction() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS queue_entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue_name TEXT NOT NULL,
+                order_number TEXT,
+                store TEXT,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_queue_entries_queue ON queue_entries (queue_name, id)")
+        # next_attempt_at is NULL for entries that are never retried (error entries)
+        ensure_columns("queue_entries", {"idempotency_key": "TEXT", "next_attempt_at": "REAL"})
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_keys (
+                key TEXT PRIMARY KEY,
+                created_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_keys_created ON webhook_keys (created_at)")
+    _schema_ready = True
+
+
+def _queue_name(queue_file):
+    return os.path.basename(queue_file)
+
+
+def _import_legacy_file(queue_file):
+    """One-off import of a queue left behind by the old whole-file JSON format."""
+    if queue_file in _imported_files:
+        return
+    _imported_files.add(queue_file)
+    if not os.path.exists(queue_file):
+        return
+    try:
+        with open(queue_file, 'r') as f:
+            legacy_queue = json.load(f)
+        with transaction() as conn:
+            for entry in legacy_queue:
+                _insert(conn, entry, queue_file)
+        os.replace(queue_file, f"{queue_file}.migrated")
+        logger.info(f"Imported {len(legacy_queue)} entries from legacy queue file {queue_file}")
+    except Exception as e:
+        logger.error(f"Error importing legacy queue file {queue_file}: {str(e)}")
+
+
+def _prepare(queue_file):
+    _ensure_schema()
+    _import_legacy_file(queue_file)
+
+
+def _insert(conn, entry, queue_file, key=None):
+    now = time.time()
+    cursor = conn.execute(
+        "INSERT INTO queue_entries (queue_name, order_number, store, payload, created_at, idempotency_key, next_attempt_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (_queue_name(queue_file), str(entry.get("order_number", "Unknown")), entry.get("store"),
+         json.dumps(entry), now, key, None if "error" in entry else now)
+    )
+    return cursor.lastrowid
+
+
+def idempotency_key(store, order_number, action, data):
+    payload_hash = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+    return f"{store}|{order_number}|{action}|{payload_hash}"
+
+
+def _prune_webhook_keys(conn):
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < PRUNE_INTERVAL_SECONDS:
+        return
+    _last_prune = now
+    cutoff = now - IDEMPOTENCY_RETENTION_HOURS * 3600
+    deleted = conn.execute("DELETE FROM webhook_keys WHERE created_at < ?", (cutoff,)).rowcount
+    if deleted:
+        logger.info(f"Pruned {deleted} expired webhook idempotency keys")
+
+
+def load_entries(queue_file):
+    """Returns (entry_id, entry, next_attempt_at) in arrival order."""
+    _prepare(queue_file)
+    rows = query("SELECT id, payload, next_attempt_at FROM queue_entries WHERE queue_name = ? ORDER BY id",
+                 (_queue_name(queue_file),))
+    return [(row["id"], json.loads(row["payload"]), row["next_attempt_at"]) for row in rows]
+
+
 def load_queue(queue_file):
     try:
-        if os.path.exists(queue_file):
-            with open(queue_file, 'r') as f:
-                return json.load(f)
-        return []
+        return [entry for _, entry, _ in load_entries(queue_file)]
     except Exception as e:
         logger.error(f"Error loading queue: {str(e)}")
         return []
 
+
 def save_queue(queue, queue_file):
+    """Replaces the whole queue in one transaction. Prefer enqueue/ack for single entries."""
     try:
-        with open(queue_file, 'w') as f:
-            json.dump(queue, f)
+        _prepare(queue_file)
+        with transaction() as conn:
+            # Release the keys of the dropped entries, as _move_to_failed does, so they can be re-run from Shopify Flow
+            conn.execute("DELETE FROM webhook_keys WHERE key IN "
+                         "(SELECT idempotency_key FROM queue_entries WHERE queue_name = ?)", (_queue_name(queue_file),))
+            conn.execute("DELETE FROM queue_entries WHERE queue_name = ?", (_queue_name(queue_file),))
+            for entry in queue:
+                _insert(conn, entry, queue_file)
     except Exception as e:
         logger.error(f"Error saving queue: {str(e)}")
 
+
+def clear_queue(queue_file):
+    save_queue([], queue_file)
+
+
+def enqueue(entry, queue_file, key=None):
+    """
+    Appends one entry. When `key` is given, the entry is only queued if that
+    idempotency key was not seen within the retention window; returns None
+    for a redelivered webhook.
+    """
+    _prepare(queue_file)
+    with transaction() as conn:
+        if key is not None:
+            _prune_webhook_keys(conn)
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO webhook_keys (key, created_at) VALUES (?, ?)", (key, time.time())
+            ).rowcount
+            if not inserted:
+                return None
+        return _insert(conn, entry, queue_file, key)
+
+
+def ack(entry_id):
+    with transaction() as conn:
+        conn.execute("DELETE FROM queue_entries WHERE id = ?", (entry_id,))
+
+
+def update_entry(entry_id, entry, next_attempt_at=None):
+    with transaction() as conn:
+        conn.execute("UPDATE queue_entries SET payload = ?, next_attempt_at = COALESCE(?, next_attempt_at) WHERE id = ?",
+                     (json.dumps(entry), next_attempt_at, entry_id))
+
+
+def retry_delay(retries):
+    """Exponential backoff with jitter, so entries failing together do not retry together."""
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (retries - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def forget_key(entry_id):
+    """Releases the idempotency key of an entry so the webhook can be re-run from Shopify Flow."""
+    with transaction() as conn:
+        conn.execute(
+            "DELETE FROM webhook_keys WHERE key = (SELECT idempotency_key FROM queue_entries WHERE id = ?)",
+            (entry_id,))
+
+
+def record_failed_order(order):
+    try:
+        with open(FAILED_ORDERS_FILE, 'a') as f:
+            json.dump(order, f)
+            f.write('\n')
+    except Exception as e:
+        logger.error(f"Error saving to failed orders: {str(e)}")
+
+
+def load_store_entries(store, queue_files, exclude_stores=None):
+    """
+    Returns (entry_id, queue_file, entry, next_attempt_at) for one store across several queues,
+    in global arrival order. With store=None, picks up entries whose store is
+    missing or not in exclude_stores.
+    """
+    for queue_file in queue_files:
+        _prepare(queue_file)
+    names = {_queue_name(queue_file): queue_file for queue_file in queue_files}
+    placeholders = ','.join('?' * len(names))
+    if store is not None:
+        rows = query(
+            f"SELECT id, queue_name, payload, next_attempt_at FROM queue_entries WHERE queue_name IN ({placeholders}) AND store = ? ORDER BY id",
+            (*names, store))
+    else:
+        excluded = list(exclude_stores or [])
+        rows = query(
+            f"SELECT id, queue_name, payload, next_attempt_at FROM queue_entries WHERE queue_name IN ({placeholders}) "
+            f"AND (store IS NULL OR store NOT IN ({','.join('?' * len(excluded))})) ORDER BY id",
+            (*names, *excluded))
+    return [(row["id"], names[row["queue_name"]], json.loads(row["payload"]), row["next_attempt_at"]) for row in rows]
+
+
+def _move_to_failed(entry_id, order):
+    logger.error(f"Order {order.get('order_number', 'Unknown')} exceeded {MAX_RETRIES} retries, moving to failed orders")
+    record_failed_order(order)
+    forget_key(entry_id)
+    ack(entry_id)
+
+
+def _begin_attempt(entry_id, order):
+    """
+    Books an attempt for a valid entry. Returns the time of the following
+    attempt, or None if the entry has run out of retries.
+    """
+    retries = order.get("retries", 0)
+    if retries >= MAX_RETRIES:
+        _move_to_failed(entry_id, order)
+        return None
+
+    retries += 1
+    order["retries"] = retries
+    # Schedule the next attempt before running, so a crash mid-attempt still backs off
+    next_attempt_at = time.time() + retry_delay(retries)
+    update_entry(entry_id, order, next_attempt_at)
+    logger.info(f"Attempting to process valid order {order.get('order_number', 'Unknown')}, retry {retries}/{MAX_RETRIES}")
+    return next_attempt_at
+
+
+def _finish_attempt(entry_id, order, success, next_attempt_at, drop_on_failure=False):
+    """
+    Acks or reschedules an attempted entry. Returns None once it has left the queue.
+    `success` is True when handled, False when it failed for good (dropped with
+    drop_on_failure) and None when it hit an error and should be tried again.
+    """
+    order_number = order.get("order_number", "Unknown")
+    if success:
+        logger.info(f"Order {order_number} processed successfully, removing from queue")
+        ack(entry_id)
+        return None
+
+    if drop_on_failure and success is False:
+        logger.warning(f"Order {order_number} not found in sheet, removing from queue permanently")
+        ack(entry_id)
+        return None
+
+    if order["retries"] >= MAX_RETRIES:
+        _move_to_failed(entry_id, order)
+        return None
+
+    logger.warning(f"Order {order_number} failed processing, retrying in {next_attempt_at - time.time():.0f}s")
+    return next_attempt_at
+
+
+def _drops_on_failure(processor_func):
+    # A fulfilment that matches nothing in the sheet will never match later
+    return processor_func.__name__ == 'remove_fulfilled_sku'
+
+
+def _process_entry(entry_id, order, processor_func):
+    """
+    Runs one queued entry. Returns None once the entry has left the queue,
+    otherwise the time at which it should be attempted again.
+    """
+    order_number = order.get("order_number", "Unknown")
+    logger.info(f"Inspecting queued order {order_number}")
+
+    if "error" in order:
+        logger.info(f"Order {order_number} has an error, keeping in queue: {order['error']}")
+        return float('inf')
+
+    next_attempt_at = _begin_attempt(entry_id, order)
+    if next_attempt_at is None:
+        return None
+    success = processor_func(order)
+    return _finish_attempt(entry_id, order, success, next_attempt_at, _drops_on_failure(processor_func))
+
+
+def _process_batch(batch, batch_func, drop_on_failure):
+    """Runs several entries of one queue through a batch processor. Returns one result per entry, as _process_entry."""
+    attempts = []
+    results = [None] * len(batch)
+    for position, (entry_id, order) in enumerate(batch):
+        next_attempt_at = _begin_attempt(entry_id, order)
+        if next_attempt_at is not None:
+            attempts.append((position, entry_id, order, next_attempt_at))
+    if not attempts:
+        return results
+
+    logger.info(f"Processing batch of {len(attempts)} queued orders")
+    try:
+        successes = batch_func([order for _, _, order, _ in attempts])
+    except Exception as e:
+        logger.error(f"Batch processing failed: {str(e)}")
+        successes = [None] * len(attempts)  # an error, not a miss: retry rather than drop
+
+    for (position, entry_id, order, next_attempt_at), success in zip(attempts, successes):
+        results[position] = _finish_attempt(entry_id, order, success, next_attempt_at, drop_on_failure)
+    return results
+
+
+def _is_due(next_attempt_at, now):
+    return next_attempt_at is None or next_attempt_at <= now
+
+
 def process_queue(queue_file, processor_func):
-    queue = load_queue(queue_file)
-    if not queue:
+    entries = load_entries(queue_file)
+    if not entries:
         logger.info("Queue is empty, nothing to process")
         return
 
-    updated_queue = []
-    max_retries = 3
+    remaining = 0
+    now = time.time()
+    for entry_id, order, next_attempt_at in entries:
+        if "error" in order or _is_due(next_attempt_at, now):
+            if _process_entry(entry_id, order, processor_func) is None:
+                continue
+        remaining += 1
+
+    logger.info(f"Queue processing complete. New queue size: {remaining}")
+
+
+def process_store_queue(store, processors, exclude_stores=None, batch_processors=None, batch_size=50):
+    """
+    Drains every queue in `processors` ({queue_file: processor_func}) for one
+    store, strictly in arrival order per order number: once an event for an
+    order stays queued, later events for that order wait until it clears so
+    a removeFulfilledSKU can never overtake its addNewOrders.
+
+    Due entries of a queue listed in `batch_processors` ({queue_file:
+    batch_func}) are gathered and handed over together; the batch is flushed
+    early whenever a later event for one of its orders comes up.
+
+    Returns the earliest time a remaining entry becomes due, or None.
+    """
+    batch_processors = batch_processors or {}
+    entries = load_store_entries(store, list(processors), exclude_stores)
+    if not entries:
+        return None
 
-    for order in queue:
+    blocked_orders = set()
+    remaining = []
+    batches = {queue_file: [] for queue_file in batch_processors}
+
+    def settle(order, next_attempt_at):
+        if next_attempt_at is None:
+            return
+        remaining.append(next_attempt_at)
         order_number = order.get("order_number", "Unknown")
-        logger.info(f"Inspecting queued order {order_number}")
+        if "error" not in order and order_number != "Unknown":
+            blocked_orders.add(order_number)
+
+    def flush(queue_file):
+        batch = batches[queue_file]
+        if batch:
+            results = _process_batch(batch, batch_processors[queue_file], _drops_on_failure(processors[queue_file]))
+            for (_, order), next_attempt_at in zip(batch, results):
+                settle(order, next_attempt_at)
+            batch.clear()
+
+    now = time.time()
+    for entry_id, queue_file, order, next_attempt_at in entries:
+        order_number = order.get("order_number", "Unknown")
+        for batch_queue, batch in batches.items():
+            if any(queued.get("order_number") == order_number for _, queued in batch):
+                flush(batch_queue)
+
+        if order_number in blocked_orders:
+            logger.info(f"Order {order_number} has an earlier queued event, deferring")
+            remaining.append(float('inf'))
+            continue
 
         if "error" in order:
             logger.info(f"Order {order_number} has an error, keeping in queue: {order['error']}")
-            updated_queue.append(order)
+            remaining.append(float('inf'))
+            continue
+
+        if not _is_due(next_attempt_at, now):
+            settle(order, next_attempt_at)
             continue
 
-        retries = order.get("retries", 0)
-        if retries >= max_retries:
-            logger.error(f"Order {order_number} exceeded {max_retries} retries, moving to failed orders")
-            try:
-                with open(FAILED_ORDERS_FILE, 'a') as f:
-                    json.dump(order, f)
-                    f.write('\n')
-            except Exception as e:
-                logger.error(f"Error saving to failed orders: {str(e)}")
+        if queue_file in batches:
+            batches[queue_file].append((entry_id, order))
+            if len(batches[queue_file]) >= batch_size:
+                flush(queue_file)
             continue
 
-        order["retries"] = retries + 1
-        logger.info(f"Attempting to process valid order {order_number}, retry {retries + 1}/{max_retries}")
-        success = processor_func(order)
-
-        if success:
-            logger.info(f"Order {order_number} processed successfully, removing from queue")
-        else:
-            if processor_func.__name__ == 'remove_fulfilled_sku':
-                logger.warning(f"Order {order_number} not found in sheet, removing from queue permanently")
-                # 🚫 Do not re-add to updated_queue
-            else:
-                logger.warning(f"Order {order_number} failed processing, keeping in queue")
-                updated_queue.append(order)
-
-        time.sleep(1)
-
-    save_queue(updated_queue, queue_file)
-    logger.info(f"Queue processing complete. New queue size: {len(updated_queue)}")
-    time.sleep(2)
+        settle(order, _process_entry(entry_id, order, processors[queue_file]))
+
+    for queue_file in batches:
+        flush(queue_file)
+
+    logger.info(f"Store {store or 'other'} queue pass complete. Remaining: {len(remaining)}")
+    next_due = min(remaining, default=float('inf'))
+    return next_due if next_due != float('inf') else None
@@ -0,0 +1,110 @@
+import fcntl
+import logging
+import threading
+import time
+from config import QUEUE_FILE, FULFILLED_QUEUE_FILE, WORKER_LOCK_FILE, QUEUE_POLL_SECONDS, STORES
+from config import QUEUE_BATCH_WINDOW_SECONDS, QUEUE_BATCH_SIZE, FULFILLED_TOMBSTONES, COMPACTION_INTERVAL_SECONDS
+from services.queue_handler import process_store_queue
+from services.reference_data import start_refresher, add_listener
+from services.order_processor import process_order, process_orders, remove_fulfilled_sku, remove_fulfilled_skus
+from services.order_processor import compact_fulfilled_rows, reeta_changed_rows
+
+logger = logging.getLogger(__name__)
+
+# Lanes pull from both queues in global arrival order
+PROCESSORS = {
+    QUEUE_FILE: process_order,
+    FULFILLED_QUEUE_FILE: remove_fulfilled_sku,
+}
+
+# New orders for a store are written with one append per pass, and
+# fulfilments with one combined row removal
+BATCH_PROCESSORS = {
+    QUEUE_FILE: process_orders,
+    FULFILLED_QUEUE_FILE: remove_fulfilled_skus,
+}
+
+# One lane per store writes to its own "Orders {store}" tab; the None lane
+# picks up entries without a recognised store.
+LANES = [*STORES, None]
+
+_wake = {lane: threading.Event() for lane in LANES}
+_thread = None
+_lock_handle = None
+
+
+def notify_worker(store=None):
+    """Wakes the lane for `store` (or every lane) so a new entry is picked up straight away."""
+    if store in STORES:
+        _wake[store].set()
+        return
+    for event in _wake.values():
+        event.set()
+
+
+def start_worker():
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _thread = threading.Thread(target=_run, name="queue-worker", daemon=True)
+    _thread.start()
+    logger.info("Queue worker started")
+
+
+def _acquire_leader_lock():
+    """
+    Only one process may drain the queues at a time (gunicorn can run several
+    workers against the same database). The flock is released automatically
+    if the owning process dies, letting another process take over.
+    """
+    global _lock_handle
+    handle = open(WORKER_LOCK_FILE, 'w')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _lock_handle = handle
+    return True
+
+
+def _run_lane(store):
+    wake = _wake[store]
+    while True:
+        next_due = None
+        try:
+            next_due = process_store_queue(store, PROCESSORS, exclude_stores=STORES if store is None else None,
+                                           batch_processors=BATCH_PROCESSORS, batch_size=QUEUE_BATCH_SIZE)
+        except Exception as e:
+            logger.error(f"Error in queue lane {store or 'other'}: {str(e)}")
+        # Sleep until the next scheduled retry, new traffic, or the poll interval, whichever comes first
+        timeout = QUEUE_POLL_SECONDS if next_due is None else min(QUEUE_POLL_SECONDS, max(0.0, next_due - time.time()))
+        if wake.wait(timeout=timeout):
+            # Woken by a webhook: give the rest of a burst a moment to arrive
+            time.sleep(QUEUE_BATCH_WINDOW_SECONDS)
+        wake.clear()
+
+
+def _run_compaction():
+    while True:
+        time.sleep(COMPACTION_INTERVAL_SECONDS)
+        compact_fulfilled_rows()
+
+
+def _run():
+    while not _acquire_leader_lock():
+        logger.info("Another process owns the queue worker, waiting")
+        _wake[None].wait(timeout=QUEUE_POLL_SECONDS)
+        _wake[None].clear()
+
+    # Only the process that drains the queues needs the ETA reference data
+    add_listener(reeta_changed_rows)
+    start_refresher()
+
+    for store in LANES:
+        threading.Thread(target=_run_lane, args=(store,), name=f"queue-lane-{store or 'other'}", daemon=True).start()
+    logger.info(f"Started {len(LANES)} queue lanes")
+
+    if FULFILLED_TOMBSTONES:
+        threading.Thread(target=_run_compaction, name="sheet-compaction", daemon=True).start()
+        logger.info(f"Compacting fulfilled rows every {COMPACTION_INTERVAL_SECONDS:.0f}s")
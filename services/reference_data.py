@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import threading
+import time
+from config import REFERENCE_REFRESH_SECONDS, REFERENCE_SNAPSHOT_FILE
+from utils.eta import EtaIndex, load_sheet_data
+
+logger = logging.getLogger(__name__)
+
+ARRIVAL_SHEET_ID = "1hElJ_sWXGy1-Psk9x2EPrXeZuFjKreR_B7cj3voxBIA"
+WEBSTOCKS_SHEET_ID = "102UjR-rv6X5k3p22x0wE6r-5BWe7e4-FNjx3SbB05Gg"
+
+# How often the refresher looks for a snapshot written by another process
+SNAPSHOT_CHECK_SECONDS = 60
+
+_current = None
+_snapshot_mtime = None
+_load_lock = threading.Lock()
+_refresher = None
+_listeners = []
+
+
+class ReferenceData:
+    """
+    One immutable version of the ETA index compiled from the arrival sheet
+    and the set of SKUs/barcodes on webstocks. A refresh builds a new instance
+    and swaps it in whole, so a caller holding one never sees a mix of two.
+    """
+
+    def __init__(self, arrival_data, stock_data, version, loaded_at):
+        self.arrival_data = arrival_data
+        self.eta_index = EtaIndex(arrival_data)
+        self.stock_data = stock_data
+        self.version = version
+        self.loaded_at = loaded_at
+
+
+def _fetch():
+    arrival_data = load_sheet_data(ARRIVAL_SHEET_ID, "General!A1:G")
+    webstocks_data = load_sheet_data(WEBSTOCKS_SHEET_ID, "webstocks!A2:A")
+    stock_data = set(row[0] for row in webstocks_data if row)  # Flatten to set of SKUs/barcodes
+    return arrival_data, stock_data
+
+
+def _next_version():
+    return _current.version + 1 if _current is not None else 1
+
+
+def _save_snapshot(data):
+    """Writes the last good version to disk (atomically) so a restart has data before Google answers."""
+    global _snapshot_mtime
+    try:
+        tmp_file = f"{REFERENCE_SNAPSHOT_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({
+                "version": data.version,
+                "loaded_at": data.loaded_at,
+                "arrival_data": data.arrival_data,
+                "stock_data": sorted(data.stock_data),
+            }, f)
+        os.replace(tmp_file, REFERENCE_SNAPSHOT_FILE)
+        _snapshot_mtime = os.path.getmtime(REFERENCE_SNAPSHOT_FILE)
+    except Exception as e:
+        logger.error(f"Failed to save ETA reference snapshot: {str(e)}")
+
+
+def _load_snapshot():
+    """Swaps in the snapshot on disk if it is newer than the one last seen. Returns True if it did."""
+    global _current, _snapshot_mtime
+    try:
+        mtime = os.path.getmtime(REFERENCE_SNAPSHOT_FILE)
+    except OSError:
+        return False
+    if mtime == _snapshot_mtime:
+        return False
+    try:
+        with open(REFERENCE_SNAPSHOT_FILE) as f:
+            snapshot = json.load(f)
+        _snapshot_mtime = mtime
+        if _current is not None and snapshot["loaded_at"] <= _current.loaded_at:
+            return False
+        _current = ReferenceData(snapshot["arrival_data"], set(snapshot["stock_data"]),
+                                 max(_next_version(), snapshot["version"]), snapshot["loaded_at"])
+    except Exception as e:
+        logger.error(f"Failed to read ETA reference snapshot: {str(e)}")
+        return False
+    logger.info(f"Loaded ETA reference data version {_current.version} from {REFERENCE_SNAPSHOT_FILE}")
+    return True
+
+
+def add_listener(callback):
+    """Registers `callback(previous, current)`, called after a new version replaces an older one."""
+    _listeners.append(callback)
+
+
+def _notify(previous, current):
+    if previous is None or current is previous:
+        return
+    for callback in _listeners:
+        try:
+            callback(previous, current)
+        except Exception as e:
+            logger.error(f"ETA reference data listener {callback.__name__} failed: {str(e)}")
+
+
+def _refresh_locked():
+    global _current
+    arrival_data, stock_data = _fetch()
+    data = ReferenceData(arrival_data, stock_data, _next_version(), time.time())
+    _current = data
+    logger.info(f"ETA reference data now at version {data.version}: "
+                f"{len(data.eta_index)} lookup keys, {len(stock_data)} stock entries")
+    _save_snapshot(data)
+    return data
+
+
+def refresh():
+    """
+    Re-reads both sheets and swaps in a new version. Raises if either sheet
+    cannot be read, in which case the current version stays in place.
+    """
+    with _load_lock:
+        previous = _current
+        data = _refresh_locked()
+    _notify(previous, data)
+    return data
+
+
+def get_reference_data():
+    """
+    Returns the current version, loading it on first use: from the snapshot
+    on disk if there is one, otherwise from the sheets. Raises if neither is
+    available; the next call tries again.
+    """
+    if _current is None:
+        with _load_lock:
+            if _current is None and not _load_snapshot():
+                _refresh_locked()
+    return _current
+
+
+def _run_refresher():
+    try:
+        get_reference_data()
+    except Exception as e:
+        logger.error(f"Failed to warm up ETA reference data: {str(e)}")
+
+    while True:
+        current = _current
+        if current is None or time.time() - current.loaded_at >= REFERENCE_REFRESH_SECONDS:
+            try:
+                refresh()
+            except Exception as e:
+                logger.error(f"Failed to refresh ETA reference data: {str(e)}")
+        time.sleep(min(SNAPSHOT_CHECK_SECONDS, REFERENCE_REFRESH_SECONDS))
+        # Pick up a refresh triggered through the endpoint on another process
+        with _load_lock:
+            previous = _current
+            _load_snapshot()
+        _notify(previous, _current)
+
+
+def start_refresher():
+    """
+    Loads the reference data on a background thread, then keeps it fresh:
+    re-read every REFERENCE_REFRESH_SECONDS, and adopt newer snapshots
+    written by other processes.
+    """
+    global _refresher
+    if _refresher is not None and _refresher.is_alive():
+        return
+    _refresher = threading.Thread(target=_run_refresher, name="reference-data-refresher", daemon=True)
+    _refresher.start()
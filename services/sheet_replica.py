@@ -0,0 +1,223 @@
+import logging
+import threading
+import time
+from config import SPREADSHEET_ID, REPLICA_MAX_AGE_SECONDS
+from services.sheets_service import SheetSnapshot, SheetWriter, execute
+
+logger = logging.getLogger(__name__)
+
+_replicas = {}
+_registry_lock = threading.Lock()
+
+
+class SheetReplica(SheetSnapshot):
+    """
+    Process-wide copy of an "Orders {store}" tab with hash indexes on
+    Order Number, (Order Number, SKU), SKU/vendor and whole-row content;
+    tombstoned rows are left out of all but the content index. Our own
+    appends, deletes and cell writes are applied write-through; everything
+    else is picked up by a full refresh once the copy is older than
+    REPLICA_MAX_AGE_SECONDS, or when a check before a delete or cell write
+    finds the rows have moved.
+
+    Hold `lock` for the whole unit of work so row indexes stay valid.
+    """
+
+    def __init__(self, spreadsheet_id, sheet_name, columns=SheetSnapshot.COLUMNS):
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.columns = columns
+        self.rows = []
+        self.loaded_at = None
+        self.lock = threading.RLock()
+        self._by_order = {}
+        self._by_order_sku = {}
+        self._by_content = {}
+        self._by_item = {}
+        self._positions = None
+
+    def refresh(self, service):
+        with self.lock:
+            self.rows = self._fetch(service)
+            self.loaded_at = time.monotonic()
+            self._reindex()
+            logger.info(f"Refreshed replica of {self.sheet_name}: {len(self.rows)} rows")
+
+    def sync(self, service):
+        """Refreshes the copy if it was never loaded, was invalidated, or has gone stale."""
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > REPLICA_MAX_AGE_SECONDS:
+                self.refresh(service)
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def _key(self, row):
+        order_number = row[self.ORDER_NUMBER_COL] if row else ''
+        sku = row[self.SKU_COL] if len(row) > self.SKU_COL else ''
+        return order_number, sku
+
+    def _reindex(self):
+        self._by_order = {}
+        self._by_order_sku = {}
+        self._by_content = {}
+        self._by_item = {}
+        for row in self.rows:
+            self._index(row)
+        self._positions = None
+
+    def _index_keys(self, row):
+        content = (self._by_content, self.content_key(row))
+        if self.is_tombstoned(row):
+            return (content,)
+        order_number, sku = self._key(row)
+        items = tuple((self._by_item, key) for key in self.item_keys(row))
+        return ((self._by_order, order_number), (self._by_order_sku, (order_number, sku)), content) + items
+
+    def _index(self, row):
+        for index, key in self._index_keys(row):
+            index.setdefault(key, []).append(row)
+
+    def _unindex(self, row):
+        for index, key in self._index_keys(row):
+            bucket = index.get(key, [])
+            for i, indexed in enumerate(bucket):
+                if indexed is row:
+                    del bucket[i]
+                    break
+            if not bucket:
+                index.pop(key, None)
+
+    def _position(self, row):
+        """Current index of a row list, or None once it has been deleted."""
+        if self._positions is None:
+            self._positions = {id(r): i for i, r in enumerate(self.rows)}
+        return self._positions.get(id(row))
+
+    def has_order(self, order_number):
+        return order_number in self._by_order
+
+    def find_rows(self, order_number, sku=None):
+        bucket = self._by_order.get(order_number, []) if sku is None else self._by_order_sku.get((order_number, sku), [])
+        return sorted(self._position(row) for row in bucket)
+
+    def find_rows_by_item(self, names):
+        rows = {id(row): row for name in names for row in self._by_item.get(name, [])}
+        return sorted(self._position(row) for row in rows.values())
+
+    def repeated_rows(self, rows=None):
+        """
+        With `rows`, checks just those rows against the content index, so the
+        cost follows the number of new rows rather than the size of the tab.
+        Without, falls back to the full scan (used for repairs).
+        """
+        if rows is None:
+            return super().repeated_rows()
+        repeated = []
+        for row in rows:
+            position = self._position(row)
+            if position is None:
+                continue
+            earlier = [self._position(other) for other in self._by_content.get(self.content_key(row), [])
+                       if other is not row]
+            if any(other is not None and other < position for other in earlier):
+                repeated.append(position)
+        return sorted(repeated)
+
+    def record_append(self, first_row, rows):
+        with self.lock:
+            # The rows written over may already hold formula output and be indexed
+            for row in self.rows[first_row - 1:first_row - 1 + len(rows)]:
+                self._unindex(row)
+            appended = super().record_append(first_row, rows)
+            for row in appended:
+                self._index(row)
+            self._positions = None
+            return appended
+
+    def record_delete(self, indexes):
+        with self.lock:
+            for index in set(indexes):
+                if index < len(self.rows):
+                    self._unindex(self.rows[index])
+            super().record_delete(indexes)
+            self._positions = None
+
+    def record_cell(self, row_number, column, value):
+        with self.lock:
+            index = row_number - 1
+            col = ord(column) - ord('A')
+            if index >= len(self.rows):
+                self.invalidate()
+                return
+            row = self.rows[index]
+            self._unindex(row)
+            while len(row) <= col:
+                row.append('')
+            row[col] = str(value)
+            self._index(row)
+
+    def confirm_rows(self, service, indexes):
+        """
+        Re-reads just the rows about to be deleted (one batchGet) and checks
+        they still hold what the replica expects. On a mismatch the replica
+        is refreshed and False is returned so the caller can re-plan.
+        """
+        indexes = sorted(set(indexes))
+        if not indexes:
+            return True
+        ranges = [f'{self.sheet_name}!A{i + 1}:D{i + 1}' for i in indexes]
+        result = execute(service.spreadsheets().values().batchGet(
+            spreadsheetId=self.spreadsheet_id, ranges=ranges
+        ))
+        for i, value_range in zip(indexes, result.get('valueRanges', [])):
+            actual = (value_range.get('values') or [[]])[0]
+            expected = list(self.rows[i][:4]) if i < len(self.rows) else []
+            while expected and expected[-1] == '':
+                expected.pop()
+            if [str(v) for v in actual] != expected:
+                logger.warning(f"Replica of {self.sheet_name} is out of date at row {i + 1}, refreshing")
+                self.refresh(service)
+                return False
+        return True
+
+    def confirm_plan(self, service, plan):
+        """
+        Runs `plan()`, which returns a list of entries whose first element is
+        the row index they write to, and confirms those rows with confirm_rows
+        before the caller writes anything. If the replica turned out to be out
+        of date it has been refreshed, so the plan is rebuilt from it.
+        """
+        entries = plan()
+        if not self.confirm_rows(service, [entry[0] for entry in entries]):
+            entries = plan()
+        return entries
+
+
+def get_replica(sheet_name, spreadsheet_id=SPREADSHEET_ID):
+    with _registry_lock:
+        key = (spreadsheet_id, sheet_name)
+        if key not in _replicas:
+            _replicas[key] = SheetReplica(spreadsheet_id, sheet_name)
+        return _replicas[key]
+
+
+class ReplicaWriter(SheetWriter):
+    """SheetWriter that also applies its cell writes to any loaded replica once flushed."""
+
+    def __init__(self, service, spreadsheet_id=SPREADSHEET_ID, value_input_option='RAW'):
+        super().__init__(service, spreadsheet_id, value_input_option)
+        self.cells = []
+
+    def set_cell(self, sheet_name, column, row, value):
+        super().set_cell(sheet_name, column, row, value)
+        self.cells.append((sheet_name, column, row, value))
+
+    def flush(self):
+        written = super().flush()
+        for sheet_name, column, row, value in self.cells:
+            replica = _replicas.get((self.spreadsheet_id, sheet_name))
+            if replica is not None:
+                replica.record_cell(row, column, value)
+        self.cells = []
+        return written
@@ -1,54 +1,405 @@
 
 import json
 import logging
+import re
 import time
+import threading
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
 from googleapiclient.errors import HttpError
-from config import SCOPES, GOOGLE_CREDENTIALS, IS_RENDER
+from config import SCOPES, GOOGLE_CREDENTIALS, IS_RENDER, GOOGLE_API_REQUESTS_PER_MINUTE, GOOGLE_HTTP_TIMEOUT_SECONDS
+from config import FULFILLED_TOMBSTONES, TOMBSTONE_COLUMN, TOMBSTONE_MARKER
 
 logger = logging.getLogger(__name__)
-service = None
+_credentials = None
+_credentials_lock = threading.Lock()
+_local = threading.local()
+
+
+def _load_credentials():
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            if IS_RENDER:
+                if not GOOGLE_CREDENTIALS:
+                    raise ValueError("GOOGLE_CREDENTIALS environment variable is not set on Render")
+                logger.info("Loading credentials from GOOGLE_CREDENTIALS on Render")
+                _credentials = service_account.Credentials.from_service_account_info(
+                    json.loads(GOOGLE_CREDENTIALS), scopes=SCOPES)
+            else:
+                logger.info("Running locally, falling back to credentials.json")
+                _credentials = service_account.Credentials.from_service_account_file(
+                    'credentials.json', scopes=SCOPES)
+        return _credentials
+
+
+def _get_http():
+    """
+    Returns the calling thread's authorised HTTP transport. httplib2 is not
+    thread-safe, so each thread gets its own, but all of them share one
+    credentials object and therefore one access token. The transport keeps
+    its TLS connections open between calls.
+    """
+    if getattr(_local, 'http', None) is None:
+        _local.http = AuthorizedHttp(_load_credentials(), http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT_SECONDS))
+    return _local.http
 
 
 def init_service():
-    global service
+    """
+    Builds a Sheets client for the calling thread. The underlying httplib2
+    transport is not thread-safe, so queue lanes must never share one.
+    The discovery document bundled with google-api-python-client is used,
+    so building a client never touches the network.
+    """
     try:
-        if IS_RENDER:
-            if not GOOGLE_CREDENTIALS:
-                raise ValueError("GOOGLE_CREDENTIALS environment variable is not set on Render")
-            logger.info("Loading credentials from GOOGLE_CREDENTIALS on Render")
-            creds = service_account.Credentials.from_service_account_info(
-                json.loads(GOOGLE_CREDENTIALS), scopes=SCOPES)
-        else:
-            logger.info("Running locally, falling back to credentials.json")
-            creds = service_account.Credentials.from_service_account_file(
-                'credentials.json', scopes=SCOPES)
-        service = build('sheets', 'v4', credentials=creds)
+        _local.service = build('sheets', 'v4', http=_get_http(), static_discovery=True, cache_discovery=False)
         logger.info("Google Sheets API initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize Google Sheets API: {str(e)}")
-        service = None
+        _local.service = None
 
 def get_service():
-    global service
-    if service is None:
+    if getattr(_local, 'service', None) is None:
         init_service()
-    return service
+    return _local.service
 
-def update_sheet_with_retry(service, spreadsheet_id, range_to_write, body, max_attempts=3, valueInputOption='RAW'):
+
+def get_gmail_service():
+    """Gmail counterpart of get_service, sharing the calling thread's transport."""
+    if getattr(_local, 'gmail', None) is None:
+        try:
+            _local.gmail = build('gmail', 'v1', http=_get_http(), static_discovery=True, cache_discovery=False)
+            logger.info("Gmail API initialized successfully")
+        except Exception as e:
+            logger.error(f"Failed to initialize Gmail API: {str(e)}")
+            return None
+    return _local.gmail
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every Google API call in the process. The rate is
+    halved whenever Google answers 429 and climbs back towards the configured
+    budget with each successful call.
+    """
+
+    def __init__(self, requests_per_minute, burst_seconds=5):
+        self.max_rate = requests_per_minute / 60.0
+        self.min_rate = self.max_rate / 16
+        self.rate = self.max_rate
+        self.capacity = max(1.0, self.max_rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def on_throttled(self):
+        with self.lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            logger.warning(f"Google API throttled, slowing down to {self.rate * 60:.1f} requests/minute")
+
+
+rate_limiter = RateLimiter(GOOGLE_API_REQUESTS_PER_MINUTE)
+
+
+def execute(request, max_attempts=5, idempotent=True):
+    """
+    Executes a Google API request through the shared rate limiter, retrying
+    429s and 5xx errors. A 5xx can arrive after the request was applied, so a
+    request that must not be applied twice (row deletes and appends, which
+    address rows by position) passes idempotent=False and is only retried on
+    429, which Google returns before doing anything.
+    """
+    retryable = RETRYABLE_STATUSES if idempotent else (429,)
     for attempt in range(max_attempts):
+        rate_limiter.acquire()
         try:
-            return service.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id, range=range_to_write,
-                valueInputOption=valueInputOption, body=body
-            ).execute()
+            result = request.execute()
         except HttpError as e:
-            logger.error(f"Attempt {attempt + 1} failed for range {range_to_write}: {str(e)}")
-            if attempt < max_attempts - 1:
-                time.sleep(2 ** attempt)
+            if e.resp.status not in retryable or attempt == max_attempts - 1:
+                raise
+            logger.error(f"Attempt {attempt + 1} failed with status {e.resp.status}: {str(e)}")
+            if e.resp.status == 429:
+                rate_limiter.on_throttled()
             else:
+                time.sleep(2 ** attempt)
+            continue
+        rate_limiter.on_success()
+        return result
+
+
+def update_sheet_with_retry(service, spreadsheet_id, range_to_write, body, max_attempts=3, valueInputOption='RAW'):
+    try:
+        return execute(service.spreadsheets().values().update(
+            spreadsheetId=spreadsheet_id, range=range_to_write,
+            valueInputOption=valueInputOption, body=body
+        ), max_attempts=max_attempts)
+    except Exception as e:
+        logger.error(f"Failed to update range {range_to_write}: {str(e)}")
+        raise
+
+
+def append_rows(service, spreadsheet_id, sheet_name, rows):
+    """
+    Writes rows below the last row of the tab's table in one call and returns
+    the sheet row number of the first of them. Sheets picks the position,
+    so concurrent writers can never land on the same rows. The rows are
+    written into the prepared blank rows (OVERWRITE), which keeps their
+    formulas and validation in the columns we do not write.
+    """
+    # Not retried on 5xx: if the first append landed, a repeat would write the order twice
+    result = execute(service.spreadsheets().values().append(
+        spreadsheetId=spreadsheet_id, range=f'{sheet_name}!A:A',
+        valueInputOption='RAW', insertDataOption='OVERWRITE', body={'values': rows}
+    ), idempotent=False)
+    updated_range = result['updates']['updatedRange']
+    return int(re.search(r'!\$?[A-Z]+\$?(\d+)', updated_range).group(1))
+
+
+_sheet_ids = {}
+_sheet_ids_lock = threading.Lock()
+
+
+def get_sheet_id(service, spreadsheet_id, sheet_name):
+    """
+    Returns the numeric sheetId of a tab. Ids are cached per (spreadsheet, title)
+    and the spreadsheet metadata is only fetched again when a title is missing.
+    """
+    key = (spreadsheet_id, sheet_name)
+    with _sheet_ids_lock:
+        if key in _sheet_ids:
+            return _sheet_ids[key]
+
+    spreadsheet = execute(service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id, fields='sheets.properties(sheetId,title)'
+    ))
+    with _sheet_ids_lock:
+        _drop_sheet_ids(spreadsheet_id)
+        for sheet in spreadsheet.get('sheets', []):
+            properties = sheet.get('properties', {})
+            _sheet_ids[(spreadsheet_id, properties.get('title'))] = properties.get('sheetId')
+        if key in _sheet_ids:
+            return _sheet_ids[key]
+    raise Exception(f"Sheet ID not found for {sheet_name}")
+
+
+def _drop_sheet_ids(spreadsheet_id):
+    for key in [key for key in _sheet_ids if key[0] == spreadsheet_id]:
+        del _sheet_ids[key]
+
+
+def invalidate_sheet_ids(spreadsheet_id):
+    with _sheet_ids_lock:
+        _drop_sheet_ids(spreadsheet_id)
+
+
+def _is_invalid_sheet_id(e):
+    return isinstance(e, HttpError) and e.resp.status == 400 and 'No grid with id' in str(e)
+
+
+def plan_row_deletions(indexes):
+    """
+    Turns 0-based row indexes (in any order, repeats allowed) into the fewest
+    half-open (start, end) ranges covering them, bottom-most first so that no
+    deletion shifts the rows of the ones after it.
+    """
+    ranges = []
+    for i in sorted(set(indexes), reverse=True):
+        if ranges and ranges[-1][0] == i + 1:
+            ranges[-1] = (i, ranges[-1][1])
+        else:
+            ranges.append((i, i + 1))
+    return ranges
+
+
+def delete_sheet_rows(service, spreadsheet_id, sheet_name, indexes):
+    """
+    Deletes the rows at the given 0-based indexes of a tab in one batchUpdate,
+    with one deleteDimension per run of adjacent rows. A cached sheetId that
+    Google no longer recognises (tab deleted and recreated) is dropped and
+    the request is sent once more with a fresh id.
+    """
+    ranges = plan_row_deletions(indexes)
+    if not ranges:
+        return None
+    for attempt in range(2):
+        sheet_id = get_sheet_id(service, spreadsheet_id, sheet_name)
+        requests = [{
+            "deleteDimension": {
+                "range": {
+                    "sheetId": sheet_id,
+                    "dimension": "ROWS",
+                    "startIndex": start,
+                    "endIndex": end
+                }
+            }
+        } for start, end in ranges]
+        try:
+            # Not retried on 5xx: if the first delete landed, a repeat would remove the rows that moved up
+            return execute(service.spreadsheets().batchUpdate(
+                spreadsheetId=spreadsheet_id, body={"requests": requests}
+            ), idempotent=False)
+        except HttpError as e:
+            if attempt or not _is_invalid_sheet_id(e):
                 raise
-        except Exception as e:
-            logger.error(f"Unexpected error updating sheet: {str(e)}")
-            raise
+            logger.warning(f"Cached sheet ID for {sheet_name} is no longer valid, refetching")
+            invalidate_sheet_ids(spreadsheet_id)
+
+
+class SheetWriter:
+    """
+    Collects cell and range updates during a unit of work and writes them with
+    a single values().batchUpdate. Writing the same range twice keeps the last value.
+    """
+
+    def __init__(self, service, spreadsheet_id, value_input_option='RAW'):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.value_input_option = value_input_option
+        self.updates = {}
+
+    def __len__(self):
+        return len(self.updates)
+
+    def set_range(self, range_name, values):
+        self.updates[range_name] = values
+
+    def set_cell(self, sheet_name, column, row, value):
+        self.set_range(f'{sheet_name}!{column}{row}', [[value]])
+
+    def flush(self):
+        """Writes everything collected so far. Returns the number of ranges written."""
+        if not self.updates:
+            return 0
+        data = [{'range': range_name, 'values': values} for range_name, values in self.updates.items()]
+        execute(self.service.spreadsheets().values().batchUpdate(
+            spreadsheetId=self.spreadsheet_id,
+            body={'valueInputOption': self.value_input_option, 'data': data}
+        ))
+        self.updates = {}
+        return len(data)
+
+
+class SheetSnapshot:
+    """
+    One read of a tab's rows, kept in step locally with our own appends and
+    deletes so later steps of the same unit of work need no re-read.
+    Row indexes are 0-based; sheet row numbers are index + 1.
+
+    In tombstone mode the tombstone column is read as well, and rows marked
+    in it with TOMBSTONE_MARKER count as already removed.
+    """
+
+    ORDER_NUMBER_COL = 0
+    SKU_COL = 3
+    VENDOR_COL = 4
+    TOMBSTONE_COL = ord(TOMBSTONE_COLUMN) - ord('A') if FULFILLED_TOMBSTONES else None
+    COLUMNS = f'A:{TOMBSTONE_COLUMN}' if FULFILLED_TOMBSTONES else 'A:N'
+
+    def __init__(self, service, spreadsheet_id, sheet_name, columns=COLUMNS):
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.columns = columns
+        self.rows = self._fetch(service)
+
+    def _fetch(self, service):
+        result = execute(service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id, range=f'{self.sheet_name}!{self.columns}'
+        ))
+        return result.get('values', [])
+
+    def is_tombstoned(self, row):
+        return (self.TOMBSTONE_COL is not None and len(row) > self.TOMBSTONE_COL
+                and str(row[self.TOMBSTONE_COL]).startswith(TOMBSTONE_MARKER))
+
+    def has_order(self, order_number):
+        return any(row and row[self.ORDER_NUMBER_COL] == order_number and not self.is_tombstoned(row)
+                   for row in self.rows)
+
+    def find_rows(self, order_number, sku=None):
+        """Indexes of the live rows for an order (optionally one SKU of it), top to bottom."""
+        return [i for i, row in enumerate(self.rows)
+                if row and row[self.ORDER_NUMBER_COL] == order_number and not self.is_tombstoned(row)
+                and (sku is None or (len(row) > self.SKU_COL and row[self.SKU_COL] == sku))]
+
+    def item_keys(self, row):
+        """The SKU and vendor of a row, the names its ETA is looked up by."""
+        return tuple(row[col] for col in (self.SKU_COL, self.VENDOR_COL) if len(row) > col)
+
+    def find_rows_by_item(self, names):
+        """Indexes of the live rows whose SKU or vendor is in `names`, top to bottom."""
+        return [i for i, row in enumerate(self.rows)
+                if not self.is_tombstoned(row) and any(key in names for key in self.item_keys(row))]
+
+    @staticmethod
+    def content_key(row):
+        """Whole-row key for duplicate detection. Sheets drops trailing blanks, so they are ignored."""
+        end = len(row)
+        while end and row[end - 1] == '':
+            end -= 1
+        return ','.join(row[:end])
+
+    def repeated_rows(self, rows=None):
+        """
+        Indexes of rows identical to an earlier row. Given `rows` (row lists
+        from this snapshot), only those rows are reported.
+        """
+        seen = set()
+        repeated = []
+        for i, row in enumerate(self.rows):
+            key = self.content_key(row)
+            if key in seen:
+                repeated.append(i)
+            else:
+                seen.add(key)
+        if rows is not None:
+            wanted = {id(row) for row in rows}
+            repeated = [i for i in repeated if id(self.rows[i]) in wanted]
+        return repeated
+
+    def record_append(self, first_row, rows):
+        """
+        Mirrors an OVERWRITE append that landed at sheet row `first_row`: the
+        written cells replace the start of those rows and the rest is kept.
+        Returns the new row lists.
+        """
+        index = first_row - 1
+        while len(self.rows) < index + len(rows):
+            self.rows.append([])
+        for existing, row in zip(self.rows[index:index + len(rows)], rows):
+            existing[:len(row)] = [str(value) for value in row]
+        return self.rows[index:index + len(rows)]
+
+    def record_delete(self, indexes):
+        for index in sorted(set(indexes), reverse=True):
+            if index < len(self.rows):
+                del self.rows[index]
+
+    def confirm_rows(self, service, indexes):
+        """A fresh snapshot needs no re-check before deleting; replicas override this."""
+        return True
@@ -1,20 +1,38 @@
-from datetime import datetime, timedelta
+from collections import namedtuple
+from datetime import date, datetime
+from functools import lru_cache
 import re
+import sys
 
-from services.sheets_service import get_service
+from services.sheets_service import get_service, execute
+from utils.holidays import add_business_days_to_date, calendar_for_store
 
 def load_sheet_data(spreadsheet_id: str, sheet_range: str):
     """Generic loader for a sheet range like 'SheetName!A1:D'."""
     service = get_service()
     if "!" not in sheet_range:
         sheet_range += "!A1:Z"  # default full range
-    result = service.spreadsheets().values().get(
+    result = execute(service.spreadsheets().values().get(
         spreadsheetId=spreadsheet_id,
         range=sheet_range
-    ).execute()
+    ))
     return result.get('values', [])
 
 
+MONTHS = ["january", "february", "march", "april", "may", "june",
+          "july", "august", "september", "october", "november", "december"]
+
+# Kinds of ParsedEta
+BUSINESS_DAYS = "business_days"    # `days` business days after the order date
+MONTH = "month"                    # `day` of `month`, this year or next
+LITERAL = "literal"                # shown as `text`
+AWAITING_UPDATE = "awaiting_update"
+
+ParsedEta = namedtuple("ParsedEta", ["kind", "days", "month", "day", "text"], defaults=(None, None, None, None))
+
+PARSE_CACHE_SIZE = 1024
+
+
 def extract_days(eta: str) -> int | None:
     match = re.findall(r'\d+', eta)
     if not match:
@@ -24,33 +42,10 @@ def extract_days(eta: str) -> int | None:
         return days * 5
     return days
 
-def add_business_days(start_date_str: str, days_to_add: int) -> str:
-    date = datetime.fromisoformat(start_date_str.replace("Z", "+00:00"))
-    count = 0
-    while count < days_to_add:
-        date += timedelta(days=1)
-        if date.weekday() < 5:
-            count += 1
-    return date.strftime("%d/%m/%Y")
-
-def calculate_eta(order_created: str, eta_str: str) -> str:
-    days = extract_days(eta_str)
-    if days:
-        return add_business_days(order_created, days)
-    # Fallback for month-based ETA
-    return calculate_month_eta(order_created, eta_str)
-
-def calculate_month_eta(order_created: str, eta_str: str) -> str:
-    month_keywords = ["january", "february", "march", "april", "may", "june",
-                       "july", "august", "september", "october", "november", "december"]
+def _parse_month(eta_str: str) -> ParsedEta:
     eta_lower = eta_str.lower()
-    for month in month_keywords:
+    for month_number, month in enumerate(MONTHS, start=1):
         if month in eta_lower:
-            today = datetime.fromisoformat(order_created.replace("Z", "+00:00"))
-            eta_month = datetime.strptime(month.capitalize(), "%B").month
-            eta_year = today.year
-            if eta_month < today.month:
-                eta_year += 1  # move to next year if needed
             # Handle qualifiers like "Early", "Mid", "Late"
             if "early" in eta_lower:
                 day = 5
@@ -60,59 +55,184 @@ def calculate_month_eta(order_created: str, eta_str: str) -> str:
                 day = 25
             else:
                 day = 1
-            eta_date = datetime(eta_year, eta_month, day)
-            return eta_date.strftime("%d/%m/%Y")
-    return eta_str
+            return ParsedEta(MONTH, month=month_number, day=day)
+    return ParsedEta(LITERAL, text=eta_str)
 
-def calculate_eta_from_email(order_created: str, eta_str: str) -> str:
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_eta(eta_str: str) -> ParsedEta:
+    """Parses a "N days"/"N weeks" style ETA, falling back to a month or the literal text."""
+    days = extract_days(eta_str)
+    if days:
+        return ParsedEta(BUSINESS_DAYS, days=days)
+    return _parse_month(eta_str)
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_badge(badge: str | None) -> ParsedEta:
+    """Parses an arrival-sheet badge. Month badges such as "Mid March" are shown as they are."""
+    if not badge:
+        return ParsedEta(AWAITING_UPDATE)
+    if badge.lower() == "stock order":
+        badge = "2 weeks"
+    if any(x in badge.lower() for x in ["day", "week"]):
+        return parse_eta(badge)
+    if "no eta" in badge.lower():
+        return ParsedEta(AWAITING_UPDATE)
+    return ParsedEta(LITERAL, text=badge)
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_email_eta(eta_str: str) -> ParsedEta:
+    """Parses an ETA quoted in an email, where month ETAs are turned into dates."""
     eta_str = eta_str.strip()
     if any(x in eta_str.lower() for x in ["day", "week"]):
-        return calculate_eta(order_created, eta_str)
-    if any(month in eta_str.lower() for month in ["january", "february", "march", "april",
-                                                   "may", "june", "july", "august",
-                                                   "september", "october", "november", "december"]):
-        return calculate_month_eta(order_created, eta_str)
-    return eta_str
+        return parse_eta(eta_str)
+    return _parse_month(eta_str)
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _order_date(order_created: str) -> date:
+    return datetime.fromisoformat(order_created.replace("Z", "+00:00")).date()
+
+def resolve_eta(parsed: ParsedEta, order_created: str, store: str | None = None) -> str:
+    """Turns a parsed ETA into the text written to the sheet for an order created at `order_created`."""
+    if parsed.kind == BUSINESS_DAYS:
+        return add_business_days(order_created, parsed.days, store)
+    if parsed.kind == MONTH:
+        today = _order_date(order_created)
+        eta_year = today.year + 1 if parsed.month < today.month else today.year  # move to next year if needed
+        return date(eta_year, parsed.month, parsed.day).strftime("%d/%m/%Y")
+    if parsed.kind == AWAITING_UPDATE:
+        return "Awaiting Update"
+    return parsed.text
+
+def add_business_days(start_date_str: str, days_to_add: int, store: str | None = None) -> str:
+    """Adds business days to an ISO timestamp, skipping weekends and the store's public holidays."""
+    return add_business_days_to_date(_order_date(start_date_str), days_to_add,
+                                     calendar_for_store(store)).strftime("%d/%m/%Y")
+
+def add_business_days_batch(pairs, store: str | None = None) -> list[str]:
+    """add_business_days for many (start_date_str, days_to_add) pairs of one store; repeated pairs are computed once."""
+    calendar = calendar_for_store(store)
+    results = {}
+    for pair in pairs:
+        if pair not in results:
+            start_date_str, days_to_add = pair
+            results[pair] = add_business_days_to_date(_order_date(start_date_str), days_to_add,
+                                                      calendar).strftime("%d/%m/%Y")
+    return [results[pair] for pair in pairs]
+
+def calculate_eta(order_created: str, eta_str: str, store: str | None = None) -> str:
+    return resolve_eta(parse_eta(eta_str), order_created, store)
 
-def build_eta_lookup(arrival_data):
-    eta_map = {}
-    for row in arrival_data[1:]:
-        sku_or_vendor = str(row[1]).strip()
-        store = str(row[6]).strip().lower() if len(row) > 6 and row[6] else ""
-        badge = str(row[2]).strip() if len(row) > 2 else ""
+def calculate_month_eta(order_created: str, eta_str: str) -> str:
+    return resolve_eta(_parse_month(eta_str), order_created)
+
+def calculate_eta_from_email(order_created: str, eta_str: str, store: str | None = None) -> str:
+    return resolve_eta(parse_email_eta(eta_str), order_created, store)
+
+class EtaIndex:
+    """
+    ETA badges from the arrival sheet, compiled into two tiers: per-store
+    entries keyed by (SKU or vendor, store) and global entries keyed by SKU
+    or vendor alone. A line item is looked up as sku+store, sku,
+    vendor+store, vendor; the first entry found wins, even if its badge is blank.
+    """
+
+    def __init__(self, arrival_data):
+        self.by_store = {}
+        self.by_key = {}
+        for row in arrival_data[1:]:
+            sku_or_vendor = sys.intern(str(row[1]).strip())
+            store = sys.intern(str(row[6]).strip().lower() if len(row) > 6 and row[6] else "")
+            badge = sys.intern(str(row[2]).strip() if len(row) > 2 else "")
+
+            self.by_store[(sku_or_vendor, store)] = badge  # last row wins
+            self.by_key[sku_or_vendor] = self.by_key.get(sku_or_vendor) or badge  # first non-blank wins
+
+    def __len__(self):
+        return len(self.by_store) + len(self.by_key)
+
+    def changed_names(self, other):
+        """SKUs/vendors whose badge differs between this index and `other`, in any store."""
+        names = {key for key in self.by_key.keys() | other.by_key.keys()
+                 if self.by_key.get(key) != other.by_key.get(key)}
+        names.update(name for name, store in self.by_store.keys() | other.by_store.keys()
+                     if self.by_store.get((name, store)) != other.by_store.get((name, store)))
+        return names
+
+    def lookup(self, sku, vendor, store_key):
+        """Returns the badge for a line item, or None if neither its SKU nor its vendor is listed."""
+        badge = self.by_store.get((str(sku), store_key))
+        if badge is None:
+            badge = self.by_key.get(sku)
+        if badge is None:
+            badge = self.by_store.get((str(vendor), store_key))
+        if badge is None:
+            badge = self.by_key.get(vendor)
+        return badge
 
-        eta_map[f"{sku_or_vendor}|{store}"] = badge
-        eta_map[sku_or_vendor] = eta_map.get(sku_or_vendor) or badge
-    return eta_map
 
-def get_eta(sku, vendor, store, barcode, inventory, order_created, eta_map, stock_data):
-    store_key = store.lower().strip()
-    check_stock = "3 - 4 Days" if sku in stock_data or barcode in stock_data else None
+def build_eta_lookup(arrival_data):
+    return EtaIndex(arrival_data)
 
-    lookup_keys = [
-        f"{sku}|{store_key}",
-        sku,
-        f"{vendor}|{store_key}",
-        vendor
-    ]
 
-    if inventory >= 0:
-        return "Ready"
+def _item_badge(item, eta_index, store_key, stock_data):
+    sku, barcode = item.get('sku'), item.get('barcode')
+    eta = eta_index.lookup(sku, item.get('vendor'), store_key)
+    if eta is None and (sku in stock_data or barcode in stock_data):
+        eta = "3 - 4 Days"
+    return eta
 
-    eta = check_stock
-    for key in lookup_keys:
-        if key in eta_map:
-            eta = eta_map[key]
-            break
 
-    if not eta:
-        return "Awaiting Update"
+def get_eta_batch(line_items, store, order_created, eta_index, stock_data):
+    """
+    Resolves the ETA of every line item (dicts with sku, vendor, barcode and
+    inventory) of one store and order date in a single pass. Each distinct
+    badge is turned into a date only once.
+    """
+    store_key = store.lower().strip()
+    resolved = {}
+    etas = []
+    for item in line_items:
+        if item.get('inventory', -1) >= 0:
+            etas.append("Ready")
+            continue
+
+        eta = _item_badge(item, eta_index, store_key, stock_data)
+        if eta not in resolved:
+            resolved[eta] = resolve_eta(parse_badge(eta), order_created, store)
+        etas.append(resolved[eta])
+    return etas
+
+
+def get_eta_rows(line_items, store, eta_index, stock_data):
+    """
+    get_eta_batch for line items of many orders of one store, each carrying
+    its own `order_created`. Each distinct (order date, badge) is resolved
+    once, business-day badges all in one add_business_days_batch call. Items
+    whose order date cannot be parsed get None.
+    """
+    store_key = store.lower().strip()
+    keys = [None if item.get('inventory', -1) >= 0
+            else (item.get('order_created'), _item_badge(item, eta_index, store_key, stock_data))
+            for item in line_items]
+
+    resolved = {}
+    business_days = []
+    for key in dict.fromkeys(key for key in keys if key):
+        order_created, badge = key
+        parsed = parse_badge(badge)
+        try:
+            if parsed.kind == BUSINESS_DAYS:
+                _order_date(order_created)  # raises now rather than in the batch
+                business_days.append((key, (order_created, parsed.days)))
+            else:
+                resolved[key] = resolve_eta(parsed, order_created, store)
+        except ValueError:
+            resolved[key] = None
+    dates = add_business_days_batch([pair for _, pair in business_days], store)
+    resolved.update(zip((key for key, _ in business_days), dates))
+    return ["Ready" if key is None else resolved[key] for key in keys]
 
-    if eta.lower() == "stock order":
-        eta = "2 weeks"
 
-    if any(x in eta.lower() for x in ["day", "week"]):
-        return calculate_eta(order_created, eta)
-    if "no eta" in eta.lower():
-        return "Awaiting Update"
-    return eta
+def get_eta(sku, vendor, store, barcode, inventory, order_created, eta_index, stock_data):
+    item = {'sku': sku, 'vendor': vendor, 'barcode': barcode, 'inventory': inventory}
+    return get_eta_batch([item], store, order_created, eta_index, stock_data)[0]
@@ -1,108 +1,78 @@
-
 import logging
-import time
 from config import SPREADSHEET_ID, SHEET_NAME
-from services.sheets_service import get_service, update_sheet_with_retry
-from googleapiclient.errors import HttpError
+from services.sheets_service import get_service, delete_sheet_rows, SheetSnapshot
 
 logger = logging.getLogger(__name__)
-service = get_service()
 
 
-def get_sheet_id():
-    try:
-        spreadsheet = service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
-        for sheet in spreadsheet.get('sheets', []):
-            if sheet.get('properties', {}).get('title') == SHEET_NAME:
-                return sheet.get('properties', {}).get('sheetId')
-    except Exception as e:
-        logger.error(f"Error getting sheet ID: {str(e)}")
-        return None
+def _load_snapshot(snapshot):
+    if snapshot is not None:
+        return snapshot
+    return SheetSnapshot(get_service(), SPREADSHEET_ID, SHEET_NAME)
 
-def delete_rows():
-    try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID, range=f'{SHEET_NAME}!A:N'
-        ).execute()
-        values = result.get('values', [])
-        rows_to_delete = [i for i, row in enumerate(values) if len(row) > 3 and row[3] in ['Tip', '']]
+def _delete_sheet_rows(snapshot, find_rows_to_delete, replan=None):
+    """
+    Deletes the rows picked by `find_rows_to_delete(snapshot)` and mirrors the
+    deletion in the snapshot. If the snapshot turns out to be out of date the
+    rows are picked again from the refreshed copy, with `replan` if given.
+    """
+    service = get_service()
+    rows_to_delete = find_rows_to_delete(snapshot)
+    if rows_to_delete and not snapshot.confirm_rows(service, rows_to_delete):
+        rows_to_delete = (replan or find_rows_to_delete)(snapshot)
+    if not rows_to_delete:
+        return []
 
-        if not rows_to_delete:
-            return
+    rows_to_delete = sorted(set(rows_to_delete), reverse=True)
+    delete_sheet_rows(service, SPREADSHEET_ID, snapshot.sheet_name, rows_to_delete)
+    snapshot.record_delete(rows_to_delete)
+    return rows_to_delete
 
-        rows_to_delete.sort(reverse=True)
-        sheet_id = get_sheet_id()
-        requests = [{"deleteDimension": {
-            "range": {
-                "sheetId": sheet_id,
-                "dimension": "ROWS",
-                "startIndex": i,
-                "endIndex": i + 1
-            }
-        }} for i in rows_to_delete]
+def _blank_or_tip_rows(snapshot):
+    return [i for i, row in enumerate(snapshot.rows) if len(row) > 3 and row[3] in ['Tip', '']]
 
-        for attempt in range(3):
-            try:
-                service.spreadsheets().batchUpdate(
-                    spreadsheetId=SPREADSHEET_ID, body={"requests": requests}
-                ).execute()
-                logger.info(f"Deleted rows: {rows_to_delete}")
-                break
-            except HttpError as e:
-                if e.resp.status in [429, 503]:
-                    time.sleep(2 ** attempt)
-                else:
-                    raise
-            except Exception as e:
-                raise
+def _tombstoned_rows(snapshot):
+    return [i for i, row in enumerate(snapshot.rows) if i > 0 and snapshot.is_tombstoned(row)]  # never the header
+
+def _all_repeated_rows(snapshot):
+    return snapshot.repeated_rows()
+
+def delete_rows(snapshot=None):
+    """
+    Deletes rows with an empty or 'Tip' SKU. Works on `snapshot` (and keeps it
+    up to date) when given, otherwise reads the default tab.
+    """
+    try:
+        deleted = _delete_sheet_rows(_load_snapshot(snapshot), _blank_or_tip_rows)
+        if deleted:
+            logger.info(f"Deleted rows: {deleted}")
     except Exception as e:
         logger.error(f"Error in delete_rows: {str(e)}")
         raise
 
-def delete_duplicate_rows():
+def delete_duplicate_rows(snapshot=None, rows=None):
+    """
+    Deletes repeated identical rows, keeping the first. Takes an optional
+    snapshot like delete_rows. Pass `rows` (e.g. the rows just appended) to
+    check only those against the rest of the tab; without it the whole tab is
+    scanned, which is what a repair run wants.
+    """
     try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID, range=f'{SHEET_NAME}!A:N'
-        ).execute()
-        values = result.get('values', [])
-        seen = set()
-        rows_to_delete = []
-
-        for i, row in enumerate(values):
-            row_str = ','.join(row)
-            if row_str in seen:
-                rows_to_delete.append(i)
-            else:
-                seen.add(row_str)
-
-        if not rows_to_delete:
-            return
-
-        rows_to_delete.sort(reverse=True)
-        sheet_id = get_sheet_id()
-        requests = [{"deleteDimension": {
-            "range": {
-                "sheetId": sheet_id,
-                "dimension": "ROWS",
-                "startIndex": i,
-                "endIndex": i + 1
-            }
-        }} for i in rows_to_delete]
-
-        for attempt in range(3):
-            try:
-                service.spreadsheets().batchUpdate(
-                    spreadsheetId=SPREADSHEET_ID, body={"requests": requests}
-                ).execute()
-                logger.info(f"Deleted duplicate rows: {rows_to_delete}")
-                break
-            except HttpError as e:
-                if e.resp.status in [429, 503]:
-                    time.sleep(2 ** attempt)
-                else:
-                    raise
-            except Exception as e:
-                raise
+        snapshot = _load_snapshot(snapshot)
+        deleted = _delete_sheet_rows(snapshot, lambda snapshot: snapshot.repeated_rows(rows), _all_repeated_rows)
+        if deleted:
+            logger.info(f"Deleted duplicate rows: {deleted}")
     except Exception as e:
         logger.error(f"Error in delete_duplicate_rows: {str(e)}")
         raise
+
+def delete_tombstoned_rows(snapshot=None):
+    """Compaction: physically deletes every row marked in the tombstone column."""
+    try:
+        deleted = _delete_sheet_rows(_load_snapshot(snapshot), _tombstoned_rows)
+        if deleted:
+            logger.info(f"Compacted {len(deleted)} tombstoned rows")
+        return len(deleted)
+    except Exception as e:
+        logger.error(f"Error in delete_tombstoned_rows: {str(e)}")
+        raise
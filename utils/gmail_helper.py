@@ -1,29 +1,28 @@
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
 import base64
 import re
 import logging
 from datetime import datetime
 from utils.eta import calculate_eta_from_email
-from services.sheets_service import get_service
+from services.sheets_service import get_service, get_gmail_service, execute
+from services.sheet_replica import get_replica, ReplicaWriter
 from config import SPREADSHEET_ID
 
-service = get_service()
 logger = logging.getLogger(__name__)
 
 def check_new_eta_emails():
+    service = get_gmail_service()
 
     # Search for relevant emails (adjust query as needed)
-    results = service.users().messages().list(
+    results = execute(service.users().messages().list(
         userId='me',
         q='subject:"You\'ve been mentioned on order"'  # Example: adapt to your real subject
-    ).execute()
+    ))
 
     messages = results.get('messages', [])
     updates = []
 
     for msg in messages:
-        msg_data = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
+        msg_data = execute(service.users().messages().get(userId='me', id=msg['id'], format='full'))
         parts = msg_data['payload'].get('parts', [])
         body_data = ""
 
@@ -46,7 +45,7 @@ def check_new_eta_emails():
             # Calculate exact ETA
             order_created = msg_data['internalDate']  # Milliseconds since epoch
             order_created_dt = datetime.fromtimestamp(int(order_created) / 1000.0).isoformat()
-            exact_eta = calculate_eta_from_email(order_created_dt, eta_str)
+            exact_eta = calculate_eta_from_email(order_created_dt, eta_str, get_store_from_order_number(order_number))
             print(f"Order: {order_number}, SKU: {sku}, ETA: {eta_str}, Exact ETA: {exact_eta}, Order Created: {order_created_dt}")
             updates.append({
                 "order_number": order_number,
@@ -57,51 +56,49 @@ def check_new_eta_emails():
 
     return updates
 
-def get_sheet_name_from_order_number(order_number: str) -> str:
+def get_store_from_order_number(order_number: str) -> str:
     if "MLPEU" in order_number:
-        return "Orders EU"
+        return "EU"
     elif "MLPUS" in order_number:
-        return "Orders US"
+        return "US"
     else:
-        return "Orders UK"
+        return "UK"
 
-def update_latest_eta_in_sheet(updates):
-    sheet_updates = []
+def get_sheet_name_from_order_number(order_number: str) -> str:
+    return f"Orders {get_store_from_order_number(order_number)}"
+
+def _plan_eta_cells(replica, updates):
+    cells = []
     for update in updates:
         order_number = update['order_number']
-        sku = update['sku']
-        new_eta = update['exact_eta_date']
-
-        sheet_name = get_sheet_name_from_order_number(order_number)
-
-        # Fetch data from that sheet
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID, range=f'{sheet_name}!A:N'
-        ).execute()
-        rows = result.get('values', [])
-        header = rows[0]
-
-        order_number_idx = header.index('Order Number')
-        sku_idx = header.index('SKU')
-        latest_eta_on_hand_idx = header.index('Latest ETA On Hand')
-
-        for i, row in enumerate(rows[1:], start=2):
-            if len(row) > max(order_number_idx, sku_idx):
-                if row[order_number_idx] == "#MLP152009" and row[order_number_idx] == order_number and row[sku_idx] == sku:
-                    logger.info(f"Updating {sheet_name} row {i} with new ETA: {new_eta}")
-                    sheet_updates.append({
-                        'range': f'{sheet_name}!F{i}',  # Column F
-                        'values': [[new_eta]]
-                    })
-                    break  # found it, stop searching
-
-    # Perform batch update
-    if sheet_updates:
-        body = {'valueInputOption': 'RAW', 'data': sheet_updates}
-        service.spreadsheets().values().batchUpdate(
-            spreadsheetId=SPREADSHEET_ID, body=body
-        ).execute()
-        logger.info(f"Updated {len(sheet_updates)} rows across all sheets.")
+        matches = [i for i in replica.find_rows(order_number, update['sku']) if i > 0]  # skip header
+        if order_number == "#MLP152009" and matches:
+            cells.append((matches[0], update['exact_eta_date']))
+    return cells
+
+def update_latest_eta_in_sheet(updates):
+    service = get_service()
+    by_sheet = {}
+    for update in updates:
+        by_sheet.setdefault(get_sheet_name_from_order_number(update['order_number']), []).append(update)
+
+    updated = 0
+    for sheet_name, sheet_updates in by_sheet.items():
+        replica = get_replica(sheet_name)
+        writer = ReplicaWriter(service, SPREADSHEET_ID)
+        # Rows are confirmed, and the lock held, until the write is done
+        with replica.lock:
+            replica.sync(service)
+            if any(not replica.find_rows(u['order_number'], u['sku']) for u in sheet_updates):
+                # A miss is rare, so make sure it is not just the replica lagging behind
+                replica.refresh(service)
+            for i, new_eta in replica.confirm_plan(service, lambda: _plan_eta_cells(replica, sheet_updates)):
+                logger.info(f"Updating {sheet_name} row {i + 1} with new ETA: {new_eta}")
+                writer.set_cell(sheet_name, 'F', i + 1, new_eta)
+            # Perform batch update
+            updated += writer.flush()
+    if updated:
+        logger.info(f"Updated {updated} rows across all sheets.")
     else:
         logger.info("No rows matched for update.")
 
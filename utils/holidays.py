@@ -0,0 +1,154 @@
+from bisect import bisect_right
+from datetime import date, timedelta
+from functools import lru_cache
+
+# Store -> public holiday calendar used when counting business days
+STORE_CALENDARS = {
+    "UK": "GB",
+    "US": "US",
+    "EU": "DE",
+}
+
+
+def easter_sunday(year):
+    """Gregorian Easter (anonymous Gregorian algorithm)."""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def nth_weekday(year, month, weekday, n):
+    """The nth `weekday` (0=Monday) of a month; n=-1 is the last one."""
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = (date(year, month + 1, 1) if month < 12 else date(year + 1, 1, 1)) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _us_observed(day):
+    # Saturday holidays are observed on Friday, Sunday ones on Monday
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+
+def _gb_holidays(year):
+    easter = easter_sunday(year)
+    new_year = date(year, 1, 1)
+    if new_year.weekday() >= 5:
+        new_year += timedelta(days=7 - new_year.weekday())
+    christmas, boxing_day = date(year, 12, 25), date(year, 12, 26)
+    if christmas.weekday() == 5:    # Sat/Sun -> Mon 27/Tue 28
+        christmas, boxing_day = date(year, 12, 27), date(year, 12, 28)
+    elif christmas.weekday() == 6:  # Sun/Mon -> Tue 27/Mon 26
+        christmas = date(year, 12, 27)
+    elif christmas.weekday() == 4:  # Fri/Sat -> Fri 25/Mon 28
+        boxing_day = date(year, 12, 28)
+    return [
+        new_year,
+        easter - timedelta(days=2),   # Good Friday
+        easter + timedelta(days=1),   # Easter Monday
+        nth_weekday(year, 5, 0, 1),   # Early May bank holiday
+        nth_weekday(year, 5, 0, -1),  # Spring bank holiday
+        nth_weekday(year, 8, 0, -1),  # Summer bank holiday
+        christmas,
+        boxing_day,
+    ]
+
+
+def _us_holidays(year):
+    return [
+        _us_observed(date(year, 1, 1)),
+        nth_weekday(year, 1, 0, 3),   # Martin Luther King Jr. Day
+        nth_weekday(year, 2, 0, 3),   # Presidents' Day
+        nth_weekday(year, 5, 0, -1),  # Memorial Day
+        _us_observed(date(year, 6, 19)),
+        _us_observed(date(year, 7, 4)),
+        nth_weekday(year, 9, 0, 1),   # Labor Day
+        nth_weekday(year, 10, 0, 2),  # Columbus Day
+        _us_observed(date(year, 11, 11)),
+        nth_weekday(year, 11, 3, 4),  # Thanksgiving
+        _us_observed(date(year, 12, 25)),
+    ]
+
+
+def _de_holidays(year):
+    # Nationwide German holidays only; there are no substitute days
+    easter = easter_sunday(year)
+    return [
+        date(year, 1, 1),
+        easter - timedelta(days=2),   # Karfreitag
+        easter + timedelta(days=1),   # Ostermontag
+        date(year, 5, 1),
+        easter + timedelta(days=39),  # Christi Himmelfahrt
+        easter + timedelta(days=50),  # Pfingstmontag
+        date(year, 10, 3),
+        date(year, 12, 25),
+        date(year, 12, 26),
+    ]
+
+
+_CALENDAR_RULES = {
+    "GB": _gb_holidays,
+    "US": _us_holidays,
+    "DE": _de_holidays,
+}
+
+
+@lru_cache(maxsize=64)
+def holidays_between(calendar, first_year, last_year):
+    """Sorted tuple of the calendar's holidays that fall on weekdays, for the given years inclusive."""
+    rules = _CALENDAR_RULES[calendar]
+    days = {day for year in range(first_year, last_year + 1) for day in rules(year) if day.weekday() < 5}
+    return tuple(sorted(days))
+
+
+def calendar_for_store(store):
+    """The holiday calendar of a store, or None (weekends only) for an unknown store."""
+    return STORE_CALENDARS.get(str(store or "").strip().upper())
+
+
+def _add_weekdays(start, days):
+    # Counting from a weekend day is the same as counting from the Friday before it,
+    # and from a weekday every 5 business days span exactly one calendar week.
+    if days <= 0:
+        return start
+    if start.weekday() >= 5:
+        start -= timedelta(days=start.weekday() - 4)
+    weeks, remainder = divmod(days, 5)
+    end = start + timedelta(weeks=weeks)
+    while remainder:
+        end += timedelta(days=1)
+        if end.weekday() < 5:
+            remainder -= 1
+    return end
+
+
+def add_business_days_to_date(start, days, calendar=None):
+    """
+    The `days`-th business day after the date `start`, skipping weekends and
+    the calendar's holidays. Runs in a handful of steps whatever `days` is.
+    """
+    end = _add_weekdays(start, days)
+    if calendar is None or days <= 0:
+        return end
+    holidays = holidays_between(calendar, start.year, end.year + 1)
+    counted = 0
+    while True:
+        # Every holiday between start and end used up one of the business days
+        skipped = bisect_right(holidays, end) - bisect_right(holidays, start)
+        if skipped == counted:
+            return end
+        end = _add_weekdays(end, skipped - counted)
+        counted = skipped
@@ -1,16 +1,58 @@
 import requests
 import json
 import logging
+import threading
+import time
 from datetime import date
+from requests.adapters import HTTPAdapter
+from config import SHOPIFY_TIMEOUT_SECONDS, SHOPIFY_CONCURRENCY, SHOPIFY_ORDERS_PER_QUERY, SHOPIFY_THROTTLE_RETRIES
 
 logger = logging.getLogger(__name__)
 
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Fields of an order used by get_orders_data, shared by every alias in a query
+ORDER_FIELDS = """
+fragment OrderFields on Order {
+  id
+  name
+  statusPageUrl
+  tags
+  customer {
+    firstName
+    locale
+  }
+}
+"""
+
 def get_store_url(config):
     store_url = f"https://{config['API_KEY']}:{config['PASSWORD']}@{config['SHOP_NAME']}.myshopify.com/admin/api/{config['API_VERSION']}/graphql.json"
     return store_url
 
-def update_note(order, config):
+def _get_session(shopurl):
+    """
+    One pooled session per store, shared by all threads, so calls reuse
+    kept-alive connections instead of a new TLS handshake each time.
+    """
+    with _sessions_lock:
+        session = _sessions.get(shopurl)
+        if session is None:
+            session = requests.Session()
+            # Room for every pipeline thread that may talk to this store at once
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(10, 2 * SHOPIFY_CONCURRENCY))
+            session.mount("https://", adapter)
+            _sessions[shopurl] = session
+        return session
+
+def _send(config, payload):
     shopurl = get_store_url(config)
+    return _get_session(shopurl).post(shopurl, json=payload, timeout=SHOPIFY_TIMEOUT_SECONDS)
+
+def _post(config, payload):
+    return _send(config, payload).json()
+
+def update_note(order, config):
     today = date.today().strftime("%d/%m/%Y")
     new_note = f"Customer Updated {today}:\n"
 
@@ -31,11 +73,7 @@ def update_note(order, config):
     """ % order_id
 
 
-    response_query = requests.post(
-        shopurl,
-        json={"query": query_note}
-    )
-    result_query = response_query.json()
+    result_query = _post(config, {"query": query_note})
     try:
         order_data = result_query['data']['order']
         existing_note = order_data['note'] or ''
@@ -73,12 +111,7 @@ def update_note(order, config):
         }
     }
 
-    response_update = requests.post(
-        shopurl,
-        json={"query": mutation, "variables": variables}
-    )
-
-    result_update = response_update.json()
+    result_update = _post(config, {"query": mutation, "variables": variables})
     if result_update.get("errors"):
         logger.error(f"GraphQL error: {result_update['errors']}")
     elif result_update['data']['orderUpdate']['userErrors']:
@@ -88,49 +121,101 @@ def update_note(order, config):
     print(f"Note updated for order {order_data['name']}")
 
 
-def get_order_data(order_number, config):
-    shopurl = get_store_url(config)
-
-    # Step 1: Get order data (GraphQL)
-    query_order = """
-    query {
-      orders(first: 1, query: "name:%s") {
-        edges {
-          node {
-            id
-            name
-            statusPageUrl
-            tags
-            customer {
-              firstName
-              locale
-            }
-          }
-        }
-      }
+def _order_data(order_response):
+    return {
+        'Order ID': order_response['id'],
+        'Order Number': order_response['name'],
+        'Customer First Name': order_response['customer']['firstName'],
+        'Locale': order_response['customer']['locale'],
+        'Domain': order_response['statusPageUrl'],
+        'Skip Email': True if 'Skip Email' in order_response['tags'] else False,
     }
-  """ % order_number
 
 
-    response_query = requests.post(
-        shopurl,
-        json={"query": query_order}
+def _error_codes(result):
+    return {(error.get('extensions') or {}).get('code')
+            for error in result.get('errors') or [] if isinstance(error, dict)}
+
+
+def _throttle_wait(response, result):
+    """Seconds to wait before retrying a throttled request, or None if it was not throttled."""
+    if response.status_code == 429:
+        try:
+            return float(response.headers.get('Retry-After', 2))
+        except ValueError:
+            return 2.0
+    if 'THROTTLED' not in _error_codes(result):
+        return None
+    # Wait until the bucket has refilled enough to pay for this query
+    cost = (result.get('extensions') or {}).get('cost') or {}
+    status = cost.get('throttleStatus') or {}
+    try:
+        return max(1.0, (cost['requestedQueryCost'] - status['currentlyAvailable']) / status['restoreRate'])
+    except (KeyError, TypeError, ZeroDivisionError):
+        return 2.0
+
+
+def _query_orders(order_numbers, config):
+    """The GraphQL result of one aliased orders(name:) search per order number, retried while throttled."""
+    searches = "\n".join(
+        f'  o{i}: orders(first: 1, query: {json.dumps(f"name:{order_number}")}) {{ edges {{ node {{ ...OrderFields }} }} }}'
+        for i, order_number in enumerate(order_numbers)
     )
-    result_query = response_query.json()
+    payload = {"query": "query {\n%s\n}\n%s" % (searches, ORDER_FIELDS)}
+    for attempt in range(SHOPIFY_THROTTLE_RETRIES + 1):
+        response = _send(config, payload)
+        try:
+            result = response.json()
+        except ValueError:
+            result = {}
+        wait = _throttle_wait(response, result)
+        if wait is None:
+            return result
+        if attempt < SHOPIFY_THROTTLE_RETRIES:
+            logger.warning(f"Shopify throttled the lookup of {len(order_numbers)} orders, retrying in {wait:.1f}s")
+            time.sleep(wait)
+    raise RuntimeError(f"Shopify is still throttling after {SHOPIFY_THROTTLE_RETRIES} retries")
+
+
+def _fetch_orders(order_numbers, config, orders):
     try:
-        order_response = result_query['data']['orders']['edges'][0]['node']
-        logger.info(f"Retrieved data for order {order_number}")
-
-        order_data = {
-            'Order ID': order_response['id'],
-            'Order Number': order_response['name'],
-            'Customer First Name': order_response['customer']['firstName'],
-            'Locale': order_response['customer']['locale'],
-            'Domain': order_response['statusPageUrl'],
-            'Skip Email': True if 'Skip Email' in order_response['tags'] else False,
-        }
-        return order_data
+        result = _query_orders(order_numbers, config)
+        if 'MAX_COST_EXCEEDED' in _error_codes(result) and len(order_numbers) > 1:
+            # The query costs more than the bucket can ever hold: split it and try the halves
+            middle = len(order_numbers) // 2
+            logger.warning(f"Order lookup for {len(order_numbers)} orders is over the query cost limit, splitting")
+            _fetch_orders(order_numbers[:middle], config, orders)
+            _fetch_orders(order_numbers[middle:], config, orders)
+            return
+        if result.get("errors") or not result.get("data"):
+            raise RuntimeError(f"GraphQL error: {result.get('errors')}")
+        data = result["data"]
+    except Exception as e:
+        for order_number in order_numbers:
+            logger.error(f"Failed to retrieve order data for {order_number}: {str(e)}")
+            orders[order_number] = None
+        return
 
-    except (KeyError, TypeError):
-        logger.error(f"Failed to retrieve order data for {order_number}")
-        return
\ No newline at end of file
+    for i, order_number in enumerate(order_numbers):
+        try:
+            orders[order_number] = _order_data(data[f"o{i}"]['edges'][0]['node'])
+        except (KeyError, TypeError, IndexError):
+            logger.error(f"Failed to retrieve order data for {order_number}")
+            orders[order_number] = None
+
+
+def get_orders_data(order_numbers, config):
+    """
+    Looks up several orders with one GraphQL request per SHOPIFY_ORDERS_PER_QUERY
+    orders. Returns {order_number: order data, or None if it was not found}.
+    """
+    order_numbers = list(dict.fromkeys(order_numbers))
+    orders = {}
+    for start in range(0, len(order_numbers), SHOPIFY_ORDERS_PER_QUERY):
+        _fetch_orders(order_numbers[start:start + SHOPIFY_ORDERS_PER_QUERY], config, orders)
+    logger.info(f"Retrieved data for {sum(1 for o in orders.values() if o)} of {len(order_numbers)} orders")
+    return orders
+
+
+def get_order_data(order_number, config):
+    return get_orders_data([order_number], config)[order_number]